@@ -34,13 +34,17 @@
 #   jobs on the same host at once.  So something's gotta change.
 
 from datetime import datetime
+import fnmatch
 import glob
+import multiprocessing
 from optparse import OptionParser
 import os
 import parser
+import Queue
 import re
 import shutil
 import shlex
+import signal
 import socket
 import stat
 from subprocess import (Popen,
@@ -78,6 +82,7 @@ except:
 # TODO clean this up so we don't need globals...
 mongo_repo = os.getcwd() #'./'
 failfile = os.path.join(mongo_repo, 'failfile.smoke')
+timings_file = os.path.join(mongo_repo, 'smoke-timings.json')
 test_path = None
 mongod_executable = None
 mongod_port = None
@@ -87,6 +92,12 @@ file_of_commands_mode = False
 start_mongod = True
 valgrind = False
 drd = False
+reset_between_tests = False
+# seconds a test may run before it's killed, unless its suite has its own
+# limit in suiteTimeouts or --timeouts-file says otherwise; 0 is no limit
+default_timeout = 30 * 60
+timeout_overrides = {}
+hang_action = 'gdb'
 
 tests = []
 winners = []
@@ -294,6 +305,51 @@ class mongod(object):
                 for source in local.sources.find(fields=["syncedTo"]):
                     synced = synced and "syncedTo" in source and source["syncedTo"]
 
+        if reset_between_tests and not self.slave:
+            # whatever the server holds open before any test ran isn't a leak
+            conn = self.connect()
+            try:
+                self.baseline = self.open_counts(conn)
+            finally:
+                conn.disconnect()
+
+    def connect(self):
+        conn = Connection(host="127.0.0.1", port=self.port, ssl=self.kwargs.get('use_ssl'))
+        if self.auth:
+            conn.admin.authenticate("admin", "password")
+        return conn
+
+    def open_counts(self, conn):
+        # (open cursors, live transactions)
+        cursors = conn.admin.command("serverStatus")["cursors"]["totalOpen"]
+        transactions = len(conn.admin.command("showLiveTransactions")["transactions"])
+        return (cursors, transactions)
+
+    def reset(self):
+        """Drop every database but admin and local, which is much cheaper
+        than restarting mongod, and check that nothing the tests opened
+        outlived them.  Returns False if the server isn't healthy and should
+        be restarted.
+        """
+        try:
+            conn = self.connect()
+            try:
+                for name in conn.database_names():
+                    if name not in ("admin", "local"):
+                        conn.drop_database(name)
+                # dropping a database kills the cursors on it, so any left are leaks
+                cursors, transactions = self.open_counts(conn)
+            finally:
+                conn.disconnect()
+        except Exception, e:
+            print >> sys.stderr, "mongod health check failed: %s" % e
+            return False
+        if cursors > self.baseline[0] or transactions > self.baseline[1]:
+            print >> sys.stderr, "mongod health check failed: %d cursors and %d transactions leaked" % (
+                max(0, cursors - self.baseline[0]), max(0, transactions - self.baseline[1]))
+            return False
+        return True
+
     def _start(self, argv):
         """In most cases, just call subprocess.Popen(). On windows,
         add the started process to a new Job Object, so that any
@@ -367,6 +423,14 @@ class TestExitFailure(TestFailure):
     def __str__(self):
         return "test %s exited with status %d" % (self.path, self.status)
 
+class TestTimeout(TestFailure):
+    def __init__(self, *args):
+        self.path = args[0]
+        self.timeout = args[1]
+        self.status = -1
+    def __str__(self):
+        return "test %s timed out after %ds" % (self.path, self.timeout)
+
 class TestServerFailure(TestFailure):
     def __init__(self, *args):
         self.path = args[0]
@@ -469,10 +533,130 @@ def skipTest(path):
 
     return False
 
+def suite_of(path):
+    # the name in suiteGlobalConfig of the suite path belongs to, if any
+    basename = os.path.basename(path)
+    if basename in ('test', 'test.exe'):
+        return 'test'
+    if basename in ('perftest', 'perftest.exe'):
+        return 'perf'
+    rel = timing_key(path)
+    for name, (globstr, usedb) in suiteGlobalConfig.iteritems():
+        globstr = 'jstests/' + globstr
+        if os.path.dirname(rel) == os.path.dirname(globstr) and \
+                fnmatch.fnmatch(os.path.basename(rel), os.path.basename(globstr)):
+            return name
+    return None
+
+def timeout_for(path):
+    # The most specific of: --timeouts-file's entry for the test, its entry
+    # for the test's suite, suiteTimeouts, --timeout.
+    key = timing_key(path)
+    if key in timeout_overrides:
+        return timeout_overrides[key]
+    suite = suite_of(path)
+    if suite in timeout_overrides:
+        return timeout_overrides[suite]
+    if suite in suiteTimeouts and default_timeout:
+        return suiteTimeouts[suite]
+    return default_timeout
+
+def wait_for(proc, timeout):
+    # Popen.wait() with a timeout, which Python 2 lacks.  Returns None if
+    # the process is still running after timeout seconds.  The poll starts
+    # every 10ms, so short tests aren't held up, and backs off to a second.
+    if not timeout:
+        return proc.wait()
+    deadline = time.time() + timeout
+    delay = 0.01
+    while proc.poll() is None:
+        left = deadline - time.time()
+        if left <= 0:
+            return None
+        time.sleep(min(delay, left))
+        delay = min(delay * 2, 1)
+    return proc.returncode
+
+def process_group(pgid):
+    # the pids in process group pgid
+    pids = []
+    for line in check_output(['ps', '-e', '-o', 'pid=,pgid=']).splitlines():
+        fields = line.split()
+        if len(fields) == 2 and int(fields[1]) == pgid:
+            pids.append(int(fields[0]))
+    return pids
+
+def dump_backtraces(gdb, pid, out):
+    # Log the backtraces of pid's threads.  Returns False if gdb didn't get
+    # them, say because ptrace_scope keeps it from attaching.
+    log = SpooledTemporaryFile(max_size=16*1024*1024)
+    try:
+        dumper = Popen([gdb, '-p', str(pid), '-batch', '-ex', 'thread apply all bt'],
+                       stdout=log, stderr=log)
+        timed_out = wait_for(dumper, 5 * 60) is None
+        if timed_out:
+            dumper.kill()
+            dumper.wait()
+        log.seek(0)
+        text = log.read()
+    finally:
+        log.close()
+    out.write("backtraces of pid %d:\n" % pid)
+    out.write(text)
+    if timed_out:
+        out.write("gdb timed out\n")
+        return False
+    return dumper.returncode == 0 and re.search(r'^#0 ', text, re.M) is not None
+
+def kill_hung_test(proc, out):
+    # Record what every process the test started (the shell, and any mongods
+    # it forked, all in the test's process group) is doing, then kill them
+    # all.  With --hang-action=abort, or for any process gdb couldn't dump,
+    # they get SIGABRT, so they leave cores behind.
+    if os.sys.platform == "win32":
+        proc.terminate()
+        proc.wait()
+        return
+    try:
+        pids = process_group(proc.pid)
+    except Exception, e:
+        out.write("couldn't list the test's processes: %s\n" % e)
+        pids = []
+    gdb = utils.which('gdb')
+    abort = []
+    if hang_action == 'gdb' and os.path.exists(gdb):
+        for pid in pids:
+            if not dump_backtraces(gdb, pid, out):
+                out.write("no backtraces of pid %d, aborting it instead\n" % pid)
+                abort.append(pid)
+    elif hang_action in ('gdb', 'abort'):
+        abort = pids
+    for pid in abort:
+        try:
+            os.kill(pid, signal.SIGABRT)
+        except OSError:
+            pass
+    if abort:
+        # give them time to write their cores
+        wait_for(proc, 60)
+    kill_test(proc)
+
+def kill_test(proc):
+    # kill the test's whole process group and reap the test
+    if os.sys.platform == "win32":
+        proc.terminate()
+    else:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    proc.wait()
+
 def runTest(test, testnum):
     # test is a tuple of ( filename , usedb<bool> )
     # filename should be a js file to run
     # usedb is true if the test expects a mongod to be running
+    # returns False if the test was skipped, True if it ran and passed
 
     (path, usedb) = test
     (ignore, ext) = os.path.splitext(path)
@@ -485,7 +669,7 @@ def runTest(test, testnum):
             sys.stdout.flush()
         else:
             print "skipping " + path
-        return
+        return False
     if file_of_commands_mode:
         # smoke.py was invoked like "--mode files --from-file foo",
         # so don't try to interpret the test path too much
@@ -550,8 +734,6 @@ def runTest(test, testnum):
     vlog.write("         Test : %s ...\n" % mongo_test_filename)
     vlog.flush()
 
-    # FIXME: we don't handle the case where the subprocess
-    # hangs... that's bad.
     if ( argv[0].endswith( 'mongo' ) or argv[0].endswith( 'mongo.exe' ) ) and not '--eval' in argv :
         evalString = 'TestData = new Object();' + \
                      'TestData.testPath = "' + path + '";' + \
@@ -582,13 +764,33 @@ def runTest(test, testnum):
     vlog.flush()
 
     tempfile = SpooledTemporaryFile(max_size=16*1024*1024)
+    timeout = timeout_for(path)
 
     try:
         os.environ['MONGO_TEST_FILENAME'] = mongo_test_filename
         t1 = time.time()
-        r = call(buildlogger(argv), cwd=test_path,
-                 # the dbtests know how to format their own output nicely
-                 stdout=ternary(is_test_binary, vlog, tempfile))
+        out = ternary(is_test_binary, vlog, tempfile)
+        # the test, and whatever it starts, get a process group of their own
+        # so that if it hangs we can find and kill all of it
+        kwargs = {}
+        if os.sys.platform != "win32":
+            kwargs['preexec_fn'] = os.setpgrp
+        proc = Popen(buildlogger(argv), cwd=test_path,
+                     # the dbtests know how to format their own output nicely
+                     stdout=out, **kwargs)
+        try:
+            r = wait_for(proc, timeout)
+        except:
+            # the test's process group doesn't get the terminal's Ctrl-C,
+            # so don't leave the shell and its mongods running behind us
+            kill_test(proc)
+            raise
+        timed_out = r is None
+        if timed_out:
+            out.write("\n*** test timed out after %ds, killing it ***\n" % timeout)
+            out.flush()
+            kill_hung_test(proc, out)
+            r = proc.returncode
         t2 = time.time()
         del os.environ['MONGO_TEST_FILENAME']
 
@@ -602,16 +804,20 @@ def runTest(test, testnum):
             vlog.flush()
 
             if quiet:
-                if r == 0:
+                if r == 0 and not timed_out:
                     qlog.write('ok %d %s\n' % (testnum, os.path.basename(path)))
+                elif timed_out:
+                    qlog.write('not ok %d %s # timeout %ds\n' % (testnum, os.path.basename(path), timeout))
                 else:
                     qlog.write('not ok %d %s # exit %d\n' % (testnum, os.path.basename(path), r))
                 qlog.flush()
-                if r != 0:
+                if r != 0 or timed_out:
                     tempfile.seek(0)
                     for line in tempfile:
                         tlog.write(line)
                     tlog.flush()
+        if timed_out:
+            raise TestTimeout(path, timeout)
         if r != 0:
             raise TestExitFailure(path, r)
     finally:
@@ -626,8 +832,12 @@ def runTest(test, testnum):
         except Exception,e:
             print "Exception from pymongo: ", e
             raise TestServerFailure(path)
+    return True
 
-def run_tests(tests):
+def run_tests(tests, numbered=None):
+    # numbered, if given, yields (index, test) pairs to run instead of
+    # enumerate(tests), and the caller has printed the TAP plan.
+    #
     # FIXME: some suites of tests start their own mongod, so don't
     # need this.  (So long as there are no conflicts with port,
     # dbpath, etc., and so long as we shut ours down properly,
@@ -676,18 +886,38 @@ def run_tests(tests):
             if small_oplog or small_oplog_rs:
                 master.wait_for_repl()
 
+            # with --reset-between-tests, whether the next test that uses our
+            # mongod has to clean up after the last one
+            dirty = False
             tests_run = 0
-            if quiet:
-                sys.stdout.write('1..%d\n' % len(tests))
-            for tests_run, test in enumerate(tests):
+            if numbered is None:
+                if quiet:
+                    sys.stdout.write('1..%d\n' % len(tests))
+                numbered = enumerate(tests)
+            for tests_run, test in numbered:
+                if dirty and test[1] and isinstance(master, mongod):
+                    dirty = False
+                    if not master.reset():
+                        print 'restarting mongod...'
+                        master.__exit__(None, None, None)
+                        master = mongod(small_oplog_rs=small_oplog_rs,
+                                        small_oplog=small_oplog,
+                                        no_journal=no_journal,
+                                        no_preallocj=no_preallocj,
+                                        auth=auth,
+                                        authMechanism=authMechanism,
+                                        use_ssl=use_ssl).__enter__()
+                dirty = reset_between_tests
                 test_result = { "test": test[0], "start": time.time() }
                 try:
                     fails.append(test)
-                    runTest(test, tests_run + 1)
+                    ran = runTest(test, tests_run + 1)
                     fails.pop()
                     winners.append(test)
 
                     test_result["passed"] = True
+                    if not ran:
+                        test_result["skipped"] = True
                     test_result["end"] = time.time()
                     all_test_results.append( test_result )
 
@@ -721,6 +951,223 @@ def run_tests(tests):
         master.__exit__(None, None, None)
     return 0
 
+# Each --jobs worker gets this many ports, counting up from --port, for its
+# mongod and slave.
+JOB_PORT_BLOCK = 10
+
+def set_job_globals(job):
+    # Point this (forked) process at its own port block, dbpath and logs.
+    global mongod_port, smoke_db_prefix, server_log_file, tests_log
+    mongod_port = str(int(mongod_port) + job * JOB_PORT_BLOCK)
+    smoke_db_prefix = os.path.join(smoke_db_prefix or '/data/db', 'job%d' % job)
+    utils.ensureDir(smoke_db_prefix + '/')
+    if len(server_log_file) > 0:
+        server_log_file = '%s.job%d' % (server_log_file, job)
+    if tests_log is not sys.stdout:
+        tests_log = open('%s.job%d' % (tests_log.name, job), 'w')
+
+def queued_tests(queue, stop):
+    # (index, test) pairs from the shared queue, until it runs dry or some
+    # job fails without --continue-on-failure
+    while not stop.is_set():
+        item = queue.get()
+        if item is None:
+            return
+        yield item
+
+def run_job(job, queue, stop, results):
+    set_job_globals(job)
+    try:
+        r = run_tests(None, queued_tests(queue, stop))
+    except Exception, e:
+        print >> sys.stderr, "job %d failed: %s" % (job, e)
+        r = 2
+    if r != 0:
+        stop.set()
+    results.put((r, winners, losers, fails, all_test_results,
+                 replicated_collections, lost_in_slave, lost_in_master, screwy_in_slave))
+
+def timing_key(path):
+    # tests are keyed relative to the repo, so timings carry across checkouts
+    if path.startswith(mongo_repo + os.sep):
+        return path[len(mongo_repo) + 1:]
+    return path
+
+def load_timings(filename):
+    try:
+        f = open(filename, 'r')
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+    except Exception:
+        return {}
+
+def save_timings(filename, results):
+    # Fold the durations of the tests that passed into the timings file.  A
+    # failed test may have stopped early, so its time says little, and a
+    # skipped one didn't run at all.
+    timings = load_timings(filename)
+    for result in results:
+        if not result.get("passed") or result.get("skipped"):
+            continue
+        key = timing_key(result["test"])
+        duration = result["end"] - result["start"]
+        if key in timings:
+            # smooth out the odd slow run
+            duration = (timings[key] + duration) / 2
+        timings[key] = duration
+    tmp = filename + '.tmp'
+    f = open(tmp, 'w')
+    try:
+        json.dump(timings, f, indent=1, sort_keys=True)
+    finally:
+        f.close()
+    os.rename(tmp, filename)
+
+def estimated_durations(tests, timings):
+    # tests never timed are assumed to take the average time of the others,
+    # or a second each if none were
+    known = [timings[timing_key(test[0])] for test in tests if timing_key(test[0]) in timings]
+    default = known and sum(known) / len(known) or 1
+    return [timings.get(timing_key(test[0]), default) for test in tests]
+
+def longest_first(tests, timings):
+    # Handing the longest tests out first from a shared queue is LPT
+    # scheduling, so no job is left running one long test at the end.
+    durations = estimated_durations(tests, timings)
+    order = sorted(range(len(tests)), key=lambda i: -durations[i])
+    return [tests[i] for i in order]
+
+def shard_tests(tests, timings, index, count):
+    # Split tests into count shards of about equal total duration and return
+    # shard index.  Every host has to compute the same shards, so they must
+    # all read the same timings (which sharded runs don't write), and a change
+    # in the recorded times shouldn't reshuffle them (as bin packing would),
+    # so the tests are sorted by path and cut into contiguous runs of equal
+    # duration: a test moves only if it sits at the edge of a shard, and no
+    # shard is off by more than its longest test.
+    durations = estimated_durations(tests, timings)
+    if not sum(durations):
+        # all of them recorded as taking no time, so split them by count
+        durations = [1] * len(tests)
+    order = sorted(range(len(tests)), key=lambda i: timing_key(tests[i][0]))
+    total = float(sum(durations)) or 1
+    shard = []
+    load = 0
+    elapsed = 0
+    for i in order:
+        # a test goes to the shard its midpoint falls in
+        k = min(count - 1, int((elapsed + durations[i] / 2.0) / total * count))
+        elapsed += durations[i]
+        if k == index:
+            shard.append(tests[i])
+            load += durations[i]
+    print "shard %d of %d: %d of %d tests, about %ds" % (index, count, len(shard), len(tests), load)
+    return shard
+
+# Shell helpers that start servers of their own, on ports (27000, 30000,
+# 31000, ...) and dbpaths they hard-code rather than take from --port.
+server_helpers_re = re.compile(r'\b(ShardingTest|ReplSetTest|ReplSetBridge|ReplTest|ReplPair\w*|'
+                               r'MongoRunner|MongodRunner|ToolTest|SyncCCTest|startMongo\w*|'
+                               r'runMongoProgram|allocatePorts|resetDbpath)\b')
+
+# load("...") calls with a literal path, which is relative to the repo
+load_re = re.compile(r'''\bload\(\s*['"]([^'"]+)['"]\s*\)''')
+
+def uses_server_helpers(path, seen):
+    # Whether the js file at path, or any file it load()s, uses one of them
+    if path in seen:
+        return False
+    seen.add(path)
+    f = open(path, 'r')
+    try:
+        source = f.read()
+    finally:
+        f.close()
+    if server_helpers_re.search(source):
+        return True
+    for name in load_re.findall(source):
+        loaded = os.path.normpath(os.path.join(mongo_repo, name))
+        if not os.path.exists(loaded):
+            loaded = os.path.normpath(os.path.join(os.path.dirname(path), name))
+        if uses_server_helpers(loaded, seen):
+            return True
+    return False
+
+def starts_servers(test):
+    # Whether test may start servers besides using ours.  Tests that don't use
+    # our mongod, and anything but a js test, are assumed to; many usedb
+    # tests do too (most of jsSlowNightly, disk and multiVersion), so the
+    # test's source, and whatever it loads, is checked for the helpers that
+    # do it.
+    (path, usedb) = test
+    if not usedb or file_of_commands_mode or not path.endswith('.js'):
+        return True
+    try:
+        return uses_server_helpers(os.path.normpath(path), set())
+    except IOError:
+        return True
+
+def run_tests_parallel(tests, jobs):
+    # Run the tests that only use our mongod in jobs processes, each with its
+    # own mongod, taking tests from a shared queue.  Tests that start servers
+    # of their own would collide on the shell helpers' hard-coded ports and
+    # dbpaths, so they run one at a time afterwards instead.
+    parallel = []
+    serial = []
+    for test in tests:
+        if starts_servers(test):
+            serial.append(test)
+        else:
+            parallel.append(test)
+    parallel = longest_first(parallel, load_timings(timings_file))
+    if quiet:
+        sys.stdout.write('1..%d\n' % len(tests))
+    sys.stdout.flush()
+
+    queue = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    stop = multiprocessing.Event()
+    for item in enumerate(parallel):
+        queue.put(item)
+    for job in range(jobs):
+        queue.put(None)
+    procs = [multiprocessing.Process(target=run_job, args=(job, queue, stop, results))
+             for job in range(jobs)]
+    for proc in procs:
+        proc.start()
+
+    status = 0
+    pending = len(procs)
+    while pending:
+        try:
+            result = results.get(timeout=1)
+        except Queue.Empty:
+            if not [proc for proc in procs if proc.is_alive()]:
+                print >> sys.stderr, "%d jobs died without reporting results" % pending
+                status = max(status, 2)
+                break
+            continue
+        pending -= 1
+        r, w, l, f, res, rc, lis, lim, sis = result
+        status = max(status, r)
+        winners.extend(w)
+        losers.update(l)
+        fails.extend(f)
+        all_test_results.extend(res)
+        replicated_collections.extend(rc)
+        lost_in_slave.extend(lis)
+        lost_in_master.extend(lim)
+        screwy_in_slave.update(sis)
+    # if a job failed the queue may still hold tests, don't wait to flush them
+    queue.cancel_join_thread()
+    for proc in procs:
+        proc.join()
+
+    if status != 0 or not serial:
+        return status
+    return run_tests(serial, enumerate(serial, len(parallel)))
 
 def report():
     print "%d tests succeeded" % len(winners)
@@ -772,6 +1219,16 @@ suiteGlobalConfig = {"js": ("[!_]*.js", True),
                      "ssl": ("ssl/*.js", True)
                      }
 
+# Seconds a test in each suite may run before it is killed, for suites whose
+# tests take much longer than --timeout.
+suiteTimeouts = {"jsSlowNightly": 2 * 60 * 60,
+                 "jsSlowWeekly": 4 * 60 * 60,
+                 "replSets": 60 * 60,
+                 "sharding": 60 * 60,
+                 "test": 2 * 60 * 60,
+                 "perf": 2 * 60 * 60
+                 }
+
 def expand_suites(suites,expandUseDB=True):
     globstr = None
     tests = []
@@ -850,6 +1307,8 @@ def set_globals(options, tests):
     global use_ssl
     global file_of_commands_mode
     global valgrind, drd
+    global reset_between_tests
+    global default_timeout, timeout_overrides, hang_action
     start_mongod = options.start_mongod
     if hasattr(options, 'use_ssl'):
         use_ssl = options.use_ssl
@@ -907,6 +1366,21 @@ def set_globals(options, tests):
     elif quiet:
         server_log_file = os.path.join(smoke_db_prefix, "server.log")
 
+    # the replication modes compare the data on master and slave at the end
+    reset_between_tests = getattr(options, 'reset_between_tests', False) and not (small_oplog or small_oplog_rs)
+
+    if hasattr(options, 'timeout'):
+        default_timeout = options.timeout
+        hang_action = options.hang_action
+        timeout_overrides = {}
+        if options.timeouts_file:
+            # {"suite or test path relative to the repo": seconds, ...}
+            f = open(options.timeouts_file)
+            try:
+                timeout_overrides = json.load(f)
+            finally:
+                f.close()
+
     valgrind = options.valgrind
     drd = options.drd
     if valgrind and drd:
@@ -994,6 +1468,7 @@ def add_to_failfile(tests, options):
 
 def main():
     global mongod_executable, mongod_port, shell_executable, continue_on_failure, small_oplog, no_journal, no_preallocj, auth, keyFile, smoke_db_prefix, smoke_server_opts, test_path
+    global timings_file
     parser = OptionParser(usage="usage: smoke.py [OPTIONS] ARGS*")
     parser.add_option('--mode', dest='mode', default='suite',
                       help='If "files", ARGS are filenames; if "suite", ARGS are sets of tests (%default)')
@@ -1073,6 +1548,31 @@ def main():
     parser.add_option('--use-ssl', dest='use_ssl', default=False,
                       action='store_true',
                       help='Run mongo shell and mongod instances with SSL encryption')
+    parser.add_option('--reset-between-tests', dest='reset_between_tests', default=False,
+                      action='store_true',
+                      help='Keep mongod running and drop its databases between tests, restarting '
+                      'it only if it fails a health check (not with --small-oplog[-rs])')
+    parser.add_option('--timeout', dest='timeout', default=default_timeout, type='int',
+                      help='Kill tests that run longer than this many seconds, 0 for no limit; '
+                      'some suites allow longer (%default)')
+    parser.add_option('--timeouts-file', dest='timeouts_file', default=None,
+                      help='JSON file mapping suite names and test paths to their own timeouts')
+    parser.add_option('--hang-action', dest='hang_action', default=hang_action,
+                      type='choice', choices=['gdb', 'abort', 'kill'],
+                      help="Before killing a test that timed out: 'gdb' to log backtraces of "
+                      "its processes (or 'abort' if there's no gdb), 'abort' to make them "
+                      "dump core, or 'kill' (%default)")
+    parser.add_option('--timings-file', dest='timings_file', default=timings_file,
+                      help='Database of test durations, used to schedule the longest tests first (%default)')
+    parser.add_option('--shard-index', dest='shard_index', default=None, type='int',
+                      help='Run only this shard of the tests, counting from 0 (use with --shard-count)')
+    parser.add_option('--shard-count', dest='shard_count', default=None, type='int',
+                      help='Split the tests into this many shards of about equal duration.  Every '
+                      'shard must be given the same --timings-file, which is then only read, '
+                      'never updated, so the shards agree on where to cut')
+    parser.add_option('--jobs', dest='jobs', default=1, type='int',
+                      help='Run tests in this many processes, each with its own mongod '
+                      'and --smoke-db-prefix subdirectory (%default)')
 
     # Buildlogger invocation from command line
     parser.add_option('--buildlogger-builder', dest='buildlogger_builder', default=None,
@@ -1086,6 +1586,15 @@ def main():
 
     global tests
     (options, tests) = parser.parse_args()
+    timings_file = options.timings_file
+    if (options.shard_index is None) != (options.shard_count is None):
+        parser.error("--shard-index and --shard-count go together")
+    if options.shard_count is not None and not 0 <= options.shard_index < options.shard_count:
+        parser.error("--shard-index must be between 0 and --shard-count - 1")
+    if options.jobs > 1 and os.sys.platform == "win32":
+        # the jobs rely on fork() to inherit our globals
+        print "--jobs isn't supported on windows, running tests one at a time"
+        options.jobs = 1
 
     set_globals(options, tests)
 
@@ -1135,6 +1644,9 @@ def main():
 
         tests = filter( ignore_test, tests )
 
+    if options.shard_count is not None:
+        tests = shard_tests(tests, load_timings(timings_file), options.shard_index, options.shard_count)
+
     if not tests:
         print "warning: no tests specified"
         return
@@ -1163,7 +1675,10 @@ def main():
         tests = filtered_tests
 
     try:
-        run_tests(tests)
+        if options.jobs > 1:
+            run_tests_parallel(tests, options.jobs)
+        else:
+            run_tests(tests)
     finally:
         add_to_failfile(fails, options)
 
@@ -1171,6 +1686,11 @@ def main():
         f.write( json.dumps( { "results" : all_test_results } ) )
         f.close()
 
+        # each shard would record only its own tests' times, and shards cutting
+        # by different timings would run some tests twice and others never
+        if options.shard_count is None:
+            save_timings(timings_file, all_test_results)
+
         report()
 
 if __name__ == "__main__":
@@ -1,27 +1,178 @@
 #!/usr/bin/env python
 
 # read a mongodb oplog, translate oplog entries to pymongo calls on another mongodb or tokumx database
+#
+# with --tokumx, read a tokumx oplog instead.  tokumx oplog entries are keyed by a GTID _id and
+# carry the transaction's operations in an 'ops' array, or in local.oplog.refs when the
+# transaction was too big, in which case the entry has a 'ref' OID instead.
 
+import calendar
+import fnmatch
+import json
+import mmap
+import os
 import sys
 import re
+import struct
+import threading
 import time
+import zlib
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
 from pymongo import MongoClient
+from pymongo.errors import AutoReconnect, DuplicateKeyError, OperationFailure
 import bson
+from bson.son import SON
+
+def gtid_from_str(s):
+    # a GTID is 16 bytes of bindata: the primary and secondary sequence numbers, big endian
+    p, q = s.split(':')
+    return bson.Binary(struct.pack('>QQ', int(p), int(q)))
+
+def gtid_to_str(gtid):
+    return '%d:%d' % struct.unpack('>QQ', gtid)
 
 def main():
     ts = None
+    gtid = None
+    tokumx = False
     fromhost = 'localhost:33000'
     tohost = 'localhost:55000'
     verbose = 0;
+    batch_size = 1000
+    batch_age = 0.1
+    workers = 1
+    checkpoint_path = None
+    checkpoint_ns = None
+    checkpoint_every = 1.0
+    fsync_every = 1
+    initial_sync = False
+    load_workers = 4
+    includes = []
+    excludes = []
+    renames = {}
+    stats_port = None
+    stats_every = 0
+    w = 1
+    wtimeout = None
+    j = False
+    max_latency = None
+    dump_dir = None
+    replay_dir = None
+    segment_size = 64 * 1024 * 1024
+    frame_size = 1024 * 1024
     for arg in sys.argv[1:]:
         if arg == '--verbose':
             verbose += 1
             continue
+        if arg == '--initialsync':
+            initial_sync = True
+            continue
+        if arg == '--j':
+            j = True
+            continue
+        if arg == '--tokumx':
+            tokumx = True
+            continue
+        match = re.match("--gtid=(.*:.*)", arg)
+        if match:
+            gtid = gtid_from_str(match.group(1))
+            tokumx = True
+            if verbose: print("start after", gtid_to_str(gtid))
+            continue
         match = re.match("--ts=(.*):(.*)", arg)
         if match:
             ts = bson.Timestamp(int(match.group(1)), int(match.group(2)))
             if verbose: print("start after", ts)
             continue
+        match = re.match("--batchsize=(.*)", arg)
+        if match:
+            batch_size = int(match.group(1))
+            continue
+        match = re.match("--batchage=(.*)", arg)
+        if match:
+            batch_age = float(match.group(1))
+            continue
+        match = re.match("--workers=(.*)", arg)
+        if match:
+            workers = int(match.group(1))
+            continue
+        match = re.match("--w=(.*)", arg)
+        if match:
+            w = match.group(1)
+            if w.isdigit():
+                w = int(w)
+            continue
+        match = re.match("--wtimeout=(.*)", arg)
+        if match:
+            wtimeout = int(match.group(1))
+            continue
+        match = re.match("--maxlatency=(.*)", arg)
+        if match:
+            max_latency = float(match.group(1)) / 1000
+            continue
+        match = re.match("--statsport=(.*)", arg)
+        if match:
+            stats_port = int(match.group(1))
+            continue
+        match = re.match("--statsevery=(.*)", arg)
+        if match:
+            stats_every = float(match.group(1))
+            continue
+        match = re.match("--include=(.*)", arg)
+        if match:
+            includes.append(match.group(1))
+            continue
+        match = re.match("--exclude=(.*)", arg)
+        if match:
+            excludes.append(match.group(1))
+            continue
+        match = re.match("--rename=(.*):(.*)", arg)
+        if match:
+            renames[match.group(1)] = match.group(2)
+            continue
+        match = re.match("--loadworkers=(.*)", arg)
+        if match:
+            load_workers = int(match.group(1))
+            continue
+        match = re.match("--checkpoint=(.*)", arg)
+        if match:
+            checkpoint_path = match.group(1)
+            continue
+        match = re.match("--checkpointns=(.*)", arg)
+        if match:
+            checkpoint_ns = match.group(1)
+            continue
+        match = re.match("--checkpointevery=(.*)", arg)
+        if match:
+            checkpoint_every = float(match.group(1))
+            continue
+        match = re.match("--fsyncevery=(.*)", arg)
+        if match:
+            fsync_every = int(match.group(1))
+            continue
+        match = re.match("--dump=(.*)", arg)
+        if match:
+            dump_dir = match.group(1)
+            continue
+        match = re.match("--replay=(.*)", arg)
+        if match:
+            replay_dir = match.group(1)
+            continue
+        match = re.match("--segmentsize=(.*)", arg)
+        if match:
+            segment_size = int(match.group(1)) * 1024 * 1024
+            continue
+        match = re.match("--framesize=(.*)", arg)
+        if match:
+            frame_size = int(match.group(1)) * 1024
+            continue
         match = re.match("--fromhost=(.*)", arg)
         if match:
             fromhost = match.group(1)
@@ -31,76 +182,1063 @@ def main():
             tohost = match.group(1)
             continue
 
-    # connect to fromhost and tohost
-    try:
-        fromv = fromhost.split(':')
-        fromc = MongoClient(fromv[0], int(fromv[1]))
-    except:
-        print(fromv, sys.exc_info())
+    if dump_dir is not None and replay_dir is not None:
+        print("--dump and --replay are exclusive")
+        return 1
+    if initial_sync and (dump_dir is not None or replay_dir is not None):
+        print("--initialsync needs both hosts")
         return 1
+    if dump_dir is not None and checkpoint_ns is not None:
+        print("--dump checkpoints to a --checkpoint file")
+        return 1
+
+    # connect to fromhost, unless replaying a dump, and tohost, unless dumping
+    fromc = None
+    if replay_dir is None:
+        try:
+            fromv = fromhost.split(':')
+            fromc = MongoClient(fromv[0], int(fromv[1]))
+        except:
+            print(fromv, sys.exc_info())
+            return 1
+    toc = None
+    if dump_dir is None:
+        try:
+            tov = tohost.split(':')
+            toc = MongoClient(tov[0], int(tov[1]))
+        except:
+            print(tov, sys.exc_info())
+            return 1
+
+    nsfilter = NsFilter(includes, excludes, renames)
+    metrics = Metrics()
+    if stats_port is not None or stats_every:
+        start_stats(metrics, stats_port, stats_every)
+    checkpoint_col = None
+    if checkpoint_ns is not None:
+        ns = checkpoint_ns.split('.',1)
+        assert len(ns) == 2
+        checkpoint_col = toc[ns[0]][ns[1]]
+    name = fromhost
+    if replay_dir is not None:
+        name = replay_dir
+    checkpoint = Checkpoint(checkpoint_path, checkpoint_col, name, checkpoint_every, fsync_every)
+    if initial_sync:
+        tocs = [MongoClient(tov[0], int(tov[1])) for i in range(load_workers)]
+        ts, gtid = copy_all(fromc, tocs, nsfilter, tokumx, batch_size, verbose)
+    elif ts is None and gtid is None:
+        try:
+            ts, gtid = checkpoint.load()
+        except CheckpointError:
+            print(sys.exc_info()[1])
+            return 1
+        if gtid is not None:
+            tokumx = True
+            if verbose: print("resume after", gtid_to_str(gtid))
+        elif ts is not None:
+            if verbose: print("resume after", ts)
+
+    if tokumx:
+        key, pos = '_id', gtid
+    else:
+        key, pos = 'ts', ts
+    if dump_dir is not None:
+        # spool the oplog to files, with tokumx refs expanded so replay doesn't need the source
+        writer = SegmentWriter(dump_dir, segment_size, frame_size, verbose)
+        def apply_entry(oploge):
+            if 'ref' in oploge:
+                oploge = dict(oploge)
+                oploge['ops'] = tokumx_ops(fromc, oploge)
+                del oploge['ref']
+            writer.write(oploge)
+        tail(fromc.local.oplog.rs, key, pos, apply_entry, writer, checkpoint, metrics, verbose)
+        return 0
+
+    # every batch is acknowledged with this write concern
+    gle = SON([('getlasterror', 1), ('w', w)])
+    if wtimeout is not None:
+        gle['wtimeout'] = wtimeout
+    if j:
+        gle['j'] = True
+    flow = FlowControl(batch_size, workers, max_latency, verbose)
+    if workers > 1:
+        tocs = [toc] + [MongoClient(tov[0], int(tov[1])) for i in range(workers - 1)]
+        applier = ParallelApplier(tocs, flow, batch_age, gle, metrics, verbose)
+    else:
+        applier = Applier(toc, flow, batch_age, gle, metrics, verbose)
+    if initial_sync:
+        # so a restart tails from the recorded position instead of copying again
+        checkpoint.advance(applier, ts=ts, gtid=gtid)
+        checkpoint.flush(applier)
+
+    # run a tailable cursor over the from host connection's  oplog from a point in time,
+    # or read a dump, and replay each oplog entry on the to host connection
+    if tokumx:
+        def apply_entry(oploge):
+            replay_tokumx(applier, nsfilter, tokumx_ops(fromc, oploge), verbose)
+    else:
+        def apply_entry(oploge):
+            oploge = nsfilter.entry(oploge)
+            if oploge is not None:
+                replay(applier, oploge['op'], oploge, verbose)
+    if replay_dir is not None:
+        replay_segments(replay_dir, key, pos, apply_entry, applier, checkpoint, metrics, verbose)
+    else:
+        tail(fromc.local.oplog.rs, key, pos, apply_entry, applier, checkpoint, metrics, verbose)
+    return 0
+
+def copy_all(fromc, tocs, nsfilter, tokumx, batch_size, verbose):
+    # record the end of the oplog, then copy every collection into the to host with the bulk
+    # loader, one collection per to host connection at a time.  the copy is fuzzy; replaying
+    # the oplog from the recorded position afterwards brings it up to date.
+    # returns the recorded (ts, gtid)
+    ts = None
+    gtid = None
+    last = fromc.local.oplog.rs.find_one(sort=[('$natural', -1)])
+    if last is not None:
+        if tokumx:
+            gtid = last['_id']
+        else:
+            ts = last['ts']
+    namespaces = Queue()
+    for dbname in fromc.database_names():
+        if dbname == 'local':
+            continue
+        for colname in fromc[dbname].collection_names():
+            if colname.startswith('system.'):
+                continue
+            ns = dbname + '.' + colname
+            tons = nsfilter.lookup(ns)
+            if tons is not None:
+                namespaces.put((ns, tons))
+    errors = []
+    threads = [threading.Thread(target=load_worker, args=(fromc, toc, namespaces, batch_size, errors, verbose))
+               for toc in tocs]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+    return ts, gtid
+
+def load_worker(fromc, toc, namespaces, batch_size, errors, verbose):
+    # the load and its transaction belong to a connection, so pin this thread's socket
+    toc.start_request()
+    while not errors:
+        try:
+            ns, tons = namespaces.get_nowait()
+        except Empty:
+            return
+        try:
+            load_collection(fromc, toc, ns, tons, batch_size, verbose)
+        except:
+            print("load error", ns, sys.exc_info())
+            errors.append(sys.exc_info()[1])
+
+def load_collection(fromc, toc, ns, tons, batch_size, verbose):
+    # create tons on the to host with the options and indexes of ns, and fill it from ns,
+    # in one bulk load
+    dbname, colname = ns.split('.',1)
+    todbname, tocolname = tons.split('.',1)
+    fromdb = fromc[dbname]
+    info = fromdb.system.namespaces.find_one({ 'name': ns })
+    options = {}
+    if info is not None:
+        options = dict((k, v) for k, v in info.get('options', {}).items() if k != 'create')
+    indexes = []
+    for index in fromdb.system.indexes.find({ 'ns': ns }):
+        index.pop('_id', None)
+        index['ns'] = tons
+        indexes.append(index)
+    if verbose: print("load", ns, tons, options, indexes)
+    todb = toc[todbname]
+    todb.command('beginTransaction')
     try:
-        tov = tohost.split(':')
-        toc = MongoClient(tov[0], int(tov[1]))
+        todb.command(SON([('beginLoad', 1), ('ns', tocolname), ('indexes', indexes), ('options', options)]))
+        try:
+            docs = []
+            n = 0
+            for doc in fromdb[colname].find().batch_size(batch_size):
+                docs.append(doc)
+                if len(docs) >= batch_size:
+                    todb[tocolname].insert(docs)
+                    n += len(docs)
+                    docs = []
+            if docs:
+                todb[tocolname].insert(docs)
+                n += len(docs)
+            todb.command('commitLoad')
+        except:
+            todb.command('abortLoad')
+            raise
     except:
-        print(tov, sys.exc_info())
-        return 1
+        todb.command('rollbackTransaction')
+        raise
+    todb.command('commitTransaction')
+    if verbose: print("loaded", ns, n)
+
+class SourceError(Exception):
+    # reading the from host failed; the cursor is re-established, unlike errors on the to host
+    pass
+
+def source_entries(c):
+    # iterate a cursor over the from host, raising its errors as SourceError
+    while 1:
+        try:
+            oploge = next(c)
+        except StopIteration:
+            return
+        except (AutoReconnect, OperationFailure):
+            raise SourceError(sys.exc_info()[1])
+        yield oploge
 
-    # run a tailable cursor over the from host connection's  oplog from a point in time
-    # and replay each oplog entry on the to host connection
-    db = fromc.local
-    oplog = db.oplog.rs
+def tail(oplog, key, pos, apply_entry, applier, checkpoint, metrics, verbose):
+    # keep one tailable cursor open over the oplog after pos, which is a ts or, for tokumx, a
+    # GTID _id.  with await_data the server blocks each getmore until there is new data, so
+    # the cursor is only re-established when it is lost.
     while 1:
-        if ts is None:
+        if pos is None:
             qs = {}
         else:
-            qs = { 'ts': { '$gt': ts }}
+            qs = { key: { '$gt': pos }}
         if verbose: print(qs)
         c = oplog.find(qs, tailable=True, await_data=True)
+        if key == 'ts':
+            # OplogReplay: let the server find the start ts without scanning the oplog
+            c.add_option(8)
         if verbose: print(c)
-        if c.count() == 0:
+        seen = False
+        try:
+            while c.alive:
+                for oploge in source_entries(c):
+                    seen = True
+                    if verbose: print(oploge)
+                    apply_entry(oploge)
+                    pos = oploge[key]
+                    metrics.entry(source_time(oploge))
+                    if key == 'ts':
+                        checkpoint.advance(applier, ts=pos)
+                    else:
+                        checkpoint.advance(applier, gtid=pos)
+                    if buffered(c) == 0:
+                        # the next getmore may block, don't hold back what we have.  the
+                        # position is saved on checkpoint's own schedule
+                        applier.flush()
+                # an idle cursor comes back empty every few seconds, save a position that's due
+                applier.flush()
+                checkpoint.due(applier)
+        except SourceError:
+            print("lost cursor", sys.exc_info()[1])
+            seen = False
+        checkpoint.flush(applier)
+        if not seen:
+            # a tailable cursor over nothing is dead right away, don't spin on it
             time.sleep(1)
+
+def source_time(oploge):
+    # seconds since the epoch when the source wrote oploge.  mongodb oplog ts is a Timestamp,
+    # tokumx's is a date.
+    ts = oploge['ts']
+    if isinstance(ts, bson.Timestamp):
+        return ts.time
+    return calendar.timegm(ts.utctimetuple()) + ts.microsecond / 1000000.0
+
+def buffered(c):
+    # the number of entries the cursor has fetched but not returned yet
+    return len(c._Cursor__data)
+
+SEGMENT_RE = re.compile(r'oplog\.(\d+)$')
+
+class SegmentWriter(object):
+    # spool oplog entries into numbered segment files in a directory.  entries are gathered
+    # into frames of about frame_size bytes of BSON, and each frame is zlib compressed and
+    # written behind its 4 byte little endian length.  a segment is closed once it holds
+    # segment_size bytes.  it stands in for the applier, so the checkpoint only records
+    # positions whose entries are on disk.
+    def __init__(self, dirname, segment_size, frame_size, verbose):
+        self.dirname = dirname
+        self.segment_size = segment_size
+        self.frame_size = frame_size
+        self.verbose = verbose
+        self.frame = []
+        self.frame_bytes = 0
+        self.f = None
+        self.written = 0
+        self.unsynced = False
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        # never append to an old segment, its last frame may be torn
+        self.seq = 0
+        for name in os.listdir(dirname):
+            match = SEGMENT_RE.match(name)
+            if match:
+                self.seq = max(self.seq, int(match.group(1)) + 1)
+
+    def write(self, oploge):
+        data = bson.BSON.encode(oploge)
+        self.frame.append(data)
+        self.frame_bytes += len(data)
+        if self.frame_bytes >= self.frame_size:
+            self.write_frame()
+
+    def write_frame(self):
+        if not self.frame:
+            return
+        z = zlib.compress(b''.join(self.frame), 1)
+        if self.f is None or self.written >= self.segment_size:
+            self.next_segment()
+        self.f.write(struct.pack('<i', len(z)))
+        self.f.write(z)
+        self.written += 4 + len(z)
+        self.unsynced = True
+        self.frame = []
+        self.frame_bytes = 0
+
+    def next_segment(self):
+        self.close()
+        path = os.path.join(self.dirname, 'oplog.%06d' % self.seq)
+        if self.verbose: print("segment", path)
+        self.f = open(path, 'wb')
+        self.seq += 1
+        self.written = 0
+
+    def flush(self):
+        self.write_frame()
+        if self.unsynced:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self.unsynced = False
+
+    def close(self):
+        if self.f is not None:
+            self.flush()
+            self.f.close()
+            self.f = None
+
+def read_segments(dirname):
+    # yield the entries spooled by a SegmentWriter, in order, reading segments through mmap
+    names = [name for name in os.listdir(dirname) if SEGMENT_RE.match(name)]
+    names.sort(key=lambda name: int(SEGMENT_RE.match(name).group(1)))
+    for name in names:
+        path = os.path.join(dirname, name)
+        f = open(path, 'rb')
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                continue
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                off = 0
+                while off + 4 <= size:
+                    n = struct.unpack('<i', m[off:off+4])[0]
+                    if off + 4 + n > size:
+                        print("torn frame", path, off)
+                        break
+                    data = zlib.decompress(m[off+4:off+4+n])
+                    off += 4 + n
+                    for oploge in bson.decode_all(data):
+                        yield oploge
+            finally:
+                m.close()
+        finally:
+            f.close()
+
+def replay_segments(dirname, key, pos, apply_entry, applier, checkpoint, metrics, verbose):
+    # replay spooled entries after pos, like tail() does from a live oplog.  segments from
+    # successive runs of --dump may overlap, so skip anything not after the last entry applied
+    for oploge in read_segments(dirname):
+        if pos is not None and oploge[key] <= pos:
+            continue
+        if verbose: print(oploge)
+        apply_entry(oploge)
+        pos = oploge[key]
+        metrics.entry(source_time(oploge))
+        if key == 'ts':
+            checkpoint.advance(applier, ts=oploge[key])
         else:
-            for oploge in c:
-                if verbose: print(oploge)
-                op = oploge['op']
-                this_ts = oploge['ts']
-                replay(toc, op, oploge, verbose)
-                ts = this_ts
-    return 0
-def replay(toc, op, oploge, verbose):
-    if op == 'i':
-        ns = oploge['ns'].split('.',1)
-        assert len(ns) == 2
+            checkpoint.advance(applier, gtid=oploge[key])
+    checkpoint.flush(applier)
+
+def tokumx_ops(fromc, oploge):
+    # return the ops of a tokumx transaction, following its ref into local.oplog.refs if it spilled
+    if 'ops' in oploge:
+        return oploge['ops']
+    oid = oploge['ref']
+    ops = []
+    refs = fromc.local.oplog.refs
+    # ref entries are keyed by { oid, seq }, with every seq greater than 0
+    qs = { '_id': { '$gt': SON([('oid', oid), ('seq', 0)]) }}
+    for refe in source_entries(refs.find(qs).sort('_id', 1)):
+        if refe['_id']['oid'] != oid:
+            break
+        ops.extend(refe['ops'])
+    return ops
+
+# commands whose argument is the name of a collection in the command's db
+COLLECTION_COMMANDS = ('create', 'drop', 'deleteIndexes', 'dropIndexes', 'collMod',
+                       'convertToCapped', 'emptycapped', 'clean')
+
+def compile_globs(globs):
+    if not globs:
+        return None
+    return re.compile('|'.join('(?:%s)' % fnmatch.translate(g) for g in globs))
+
+class NsFilter(object):
+    # decide which namespaces are replayed and what they are called on the to host.
+    # --include and --exclude globs are compiled into one regex each, and --rename maps a db
+    # or a full ns to a new name.  the answer for each distinct ns is cached, so entries in a
+    # skipped ns cost one dict lookup.
+    def __init__(self, includes, excludes, renames):
+        self.include = compile_globs(includes)
+        self.exclude = compile_globs(excludes)
+        self.renames = renames
+        self.cache = {}
+
+    def lookup(self, ns):
+        # the to host ns for ns, or None to skip it
+        try:
+            return self.cache[ns]
+        except KeyError:
+            pass
+        tons = ns
+        if self.include is not None and not self.include.match(ns):
+            tons = None
+        elif self.exclude is not None and self.exclude.match(ns):
+            tons = None
+        elif ns in self.renames:
+            tons = self.renames[ns]
+        elif '.' in ns:
+            dbname, rest = ns.split('.',1)
+            if dbname in self.renames:
+                tons = self.renames[dbname] + '.' + rest
+        self.cache[ns] = tons
+        return tons
+
+    def entry(self, oploge):
+        # the oplog entry to replay for oploge, renamed if need be, or None to skip it.
+        # no-ops, like tokumx's keepOplogAlive comments (which have no ns) and the
+        # replica set's initiating entry (whose ns is ''), name no collection and pass through
+        ns = oploge.get('ns')
+        if oploge.get('op') == 'n' or not ns:
+            return oploge
+        if ns.endswith('.$cmd'):
+            return self.command_entry(oploge)
+        if ns.endswith('.system.indexes'):
+            # index builds name the indexed ns in the index spec
+            o = oploge['o']
+            tons = self.lookup(o['ns'])
+            if tons is None:
+                return None
+            if tons != o['ns']:
+                o = dict(o)
+                o['ns'] = tons
+                oploge = dict(oploge)
+                oploge['o'] = o
+                oploge['ns'] = tons.split('.',1)[0] + '.system.indexes'
+            return oploge
+        tons = self.lookup(ns)
+        if tons is None:
+            return None
+        if tons != ns:
+            oploge = dict(oploge)
+            oploge['ns'] = tons
+        return oploge
+
+    def command_entry(self, oploge):
+        # collection commands are filtered and renamed by the collection they name,
+        # renameCollection by both of the full namespaces it names, other commands by db.$cmd
         o = oploge['o']
-        if verbose: print("insert", ns, o)
-        db = toc[ns[0]]
-        col = db[ns[1]]
-        col.insert(o)
-    elif op == 'd':
-        ns = oploge['ns'].split('.',1)
+        if 'renameCollection' in o:
+            return self.rename_entry(oploge)
+        for cmd in COLLECTION_COMMANDS:
+            if cmd in o:
+                ns = oploge['ns'][:-len('$cmd')] + o[cmd]
+                tons = self.lookup(ns)
+                if tons is None:
+                    return None
+                if tons != ns:
+                    todbname, tocolname = tons.split('.',1)
+                    o = dict(o)
+                    o[cmd] = tocolname
+                    oploge = dict(oploge)
+                    oploge['o'] = o
+                    oploge['ns'] = todbname + '.$cmd'
+                return oploge
+        tons = self.lookup(oploge['ns'])
+        if tons is None:
+            return None
+        if tons != oploge['ns']:
+            oploge = dict(oploge)
+            oploge['ns'] = tons
+        return oploge
+
+    def rename_entry(self, oploge):
+        # renameCollection runs on admin.$cmd and names the source and target namespaces in
+        # full.  it's replayed only if both are, with both renamed.
+        o = oploge['o']
+        fromns, tons = self.lookup(o['renameCollection']), self.lookup(o['to'])
+        if fromns is None or tons is None:
+            if fromns is not None or tons is not None:
+                print("skipping rename between a replayed and a skipped ns", o)
+            return None
+        if fromns != o['renameCollection'] or tons != o['to']:
+            # the command name must stay the first key
+            o = SON([('renameCollection', fromns), ('to', tons)] +
+                    [(k, v) for k, v in o.items() if k not in ('renameCollection', 'to')])
+            oploge = dict(oploge)
+            oploge['o'] = o
+        return oploge
+
+class CheckpointError(Exception):
+    pass
+
+class Checkpoint(object):
+    # save the last applied oplog position to a local file and/or a collection on the to host,
+    # so a restart resumes where the last one stopped.  a position is saved only after the
+    # applier acknowledged everything up to it, so at most one batch is re-applied.
+    def __init__(self, path, col, name, every, fsync_every):
+        self.path = path
+        self.col = col
+        self.name = name
+        self.every = every
+        self.fsync_every = fsync_every
+        self.saves = 0
+        self.last_save = time.time()
+        self.ts = None
+        self.gtid = None
+        self.saved = (None, None)
+
+    def load(self):
+        # return the saved (ts, gtid), preferring the file.  without an fsync the rename can
+        # reach the disk before the data does, so a crash can leave the file empty or torn:
+        # then use the collection if there is one, else give up rather than guess.
+        if self.path is not None and os.path.exists(self.path):
+            f = open(self.path)
+            try:
+                data = f.read()
+            finally:
+                f.close()
+            try:
+                self.parse(data)
+            except ValueError:
+                if self.col is None:
+                    raise CheckpointError('%s is corrupt (%r), restart with --gtid or --ts' % (self.path, data))
+                print("ignoring corrupt checkpoint file", self.path, repr(data))
+        if self.ts is None and self.gtid is None and self.col is not None:
+            doc = self.col.find_one({ '_id': self.name })
+            if doc is not None:
+                self.ts = doc.get('ts')
+                self.gtid = doc.get('gtid')
+        self.saved = (self.ts, self.gtid)
+        return self.saved
+
+    def parse(self, data):
+        # raise ValueError unless data is a line save_file wrote
+        fields = data.split()
+        if len(fields) != 2 or not data.endswith('\n'):
+            raise ValueError(data)
+        kind, pos = fields
+        if kind == 'gtid':
+            self.gtid = gtid_from_str(pos)
+        elif kind == 'ts':
+            t, i = pos.split(':')
+            self.ts = bson.Timestamp(int(t), int(i))
+        else:
+            raise ValueError(data)
+
+    def advance(self, applier, ts=None, gtid=None):
+        # note that everything up to this position has been handed to the applier
+        self.ts = ts
+        self.gtid = gtid
+        self.due(applier)
+
+    def due(self, applier):
+        # save the position if the last save was at least every seconds ago
+        if time.time() - self.last_save >= self.every:
+            self.flush(applier)
+
+    def flush(self, applier):
+        applier.flush()
+        self.last_save = time.time()
+        if (self.ts, self.gtid) == self.saved:
+            return
+        self.saves += 1
+        sync = self.saves % self.fsync_every == 0
+        if self.path is not None:
+            self.save_file(sync)
+        if self.col is not None:
+            if self.gtid is not None:
+                doc = { '_id': self.name, 'gtid': self.gtid }
+            else:
+                doc = { '_id': self.name, 'ts': self.ts }
+            self.col.update({ '_id': self.name }, doc, upsert=True, w=1, j=sync)
+        self.saved = (self.ts, self.gtid)
+
+    def save_file(self, sync):
+        # write a temp file and rename it over the old one, so a crash leaves one or the other
+        if self.gtid is not None:
+            line = 'gtid %s\n' % gtid_to_str(self.gtid)
+        else:
+            line = 'ts %d:%d\n' % (self.ts.time, self.ts.inc)
+        tmp = self.path + '.tmp'
+        f = open(tmp, 'w')
+        try:
+            f.write(line)
+            f.flush()
+            if sync:
+                os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmp, self.path)
+        if sync:
+            d = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+            try:
+                os.fsync(d)
+            finally:
+                os.close(d)
+
+def bucket(histogram, v):
+    # count v in a histogram of power of two buckets, keyed by the bucket's upper bound
+    b = 1
+    while b < v:
+        b *= 2
+    histogram[b] = histogram.get(b, 0) + 1
+
+class Metrics(object):
+    # throughput, latency and lag counters.  the tail and every applier update them, so they
+    # live under one lock.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.ops = {}
+        self.rates = {}
+        self.last_ops = {}
+        self.last_tick = self.start
+        self.batches = 0
+        self.batch_sizes = {}
+        self.apply_ms = {}
+        self.lag = None
+        self.last_entry = None
+
+    def op(self, kind):
+        with self.lock:
+            self.ops[kind] = self.ops.get(kind, 0) + 1
+
+    def batch(self, size, secs):
+        with self.lock:
+            self.batches += 1
+            bucket(self.batch_sizes, size)
+            bucket(self.apply_ms, secs * 1000)
+
+    def entry(self, t):
+        # an oplog entry written by the source at t has been handed to the applier
+        now = time.time()
+        with self.lock:
+            self.lag = now - t
+            self.last_entry = now
+
+    def tick(self):
+        # recompute ops/sec per op type since the last tick
+        now = time.time()
+        with self.lock:
+            elapsed = now - self.last_tick
+            if elapsed > 0:
+                self.rates = dict((k, (v - self.last_ops.get(k, 0)) / elapsed) for k, v in self.ops.items())
+            self.last_ops = dict(self.ops)
+            self.last_tick = now
+
+    def snapshot(self):
+        now = time.time()
+        with self.lock:
+            idle = None
+            if self.last_entry is not None:
+                idle = now - self.last_entry
+            return {
+                'uptime': now - self.start,
+                'ops': dict(self.ops),
+                'ops_per_sec': dict(self.rates),
+                'batches': self.batches,
+                'batch_sizes': dict(self.batch_sizes),
+                'apply_ms': dict(self.apply_ms),
+                'lag_secs': self.lag,
+                'idle_secs': idle,
+            }
+
+    def log_line(self):
+        s = self.snapshot()
+        rates = ' '.join('%s=%.0f' % (k, v) for k, v in sorted(s['ops_per_sec'].items()))
+        lag = s['lag_secs']
+        if lag is None:
+            lag = 0
+        return 'ops/sec %s lag %.3fs batches %d' % (rates, lag, s['batches'])
+
+def start_stats(metrics, port, every):
+    # serve metrics as json on localhost:port and print them every `every` seconds
+    if port is not None:
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(metrics.snapshot()).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args):
+                pass
+        server = HTTPServer(('localhost', port), Handler)
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+    def report():
+        while 1:
+            time.sleep(every or 1)
+            metrics.tick()
+            if every:
+                print('%s %s' % (time.strftime('%c'), metrics.log_line()))
+                sys.stdout.flush()
+    t = threading.Thread(target=report)
+    t.daemon = True
+    t.start()
+
+class WriteConcernError(Exception):
+    pass
+
+class WriteError(Exception):
+    pass
+
+class FlowControl(object):
+    # adapt the batch size, and how many appliers may write at once, to the to host's latency.
+    # a batch slower than max_latency seconds halves both, a faster one grows them back a step
+    # at a time.  with no max_latency nothing changes.
+    def __init__(self, batch_size, concurrency, max_latency, verbose):
+        self.max_batch_size = batch_size
+        self.batch_size = batch_size
+        self.max_concurrency = concurrency
+        self.concurrency = concurrency
+        self.max_latency = max_latency
+        self.verbose = verbose
+        self.active = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.active >= self.concurrency:
+                self.cond.wait()
+            self.active += 1
+
+    def release(self, latency):
+        with self.cond:
+            self.active -= 1
+            if self.max_latency is not None:
+                if latency > self.max_latency:
+                    self.batch_size = max(1, self.batch_size // 2)
+                    self.concurrency = max(1, self.concurrency // 2)
+                    if self.verbose: print("slow down", latency, self.batch_size, self.concurrency)
+                else:
+                    step = max(1, self.max_batch_size // 16)
+                    self.batch_size = min(self.max_batch_size, self.batch_size + step)
+                    self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+            self.cond.notify_all()
+
+# commands that fail only because an earlier run of the same command got there first, which
+# happens when entries are replayed again after a restart or over an --initialsync copy
+IDEMPOTENT_CODES = (26, 27, 48)   # NamespaceNotFound, IndexNotFound, NamespaceExists
+IDEMPOTENT_RE = re.compile('already exists|ns not found|index not found|'
+                           'source namespace does not exist|target namespace exists')
+
+def idempotent_failure(e):
+    return getattr(e, 'code', None) in IDEMPOTENT_CODES or IDEMPOTENT_RE.search(str(e)) is not None
+
+class Applier(object):
+    # batch writes to the to host.  runs of inserts into the same ns become one multi-document
+    # insert.  at flush the batch is sent unacknowledged, in oplog order, on one socket, so the
+    # server applies ops on the same _id in order without a round trip per op, and then
+    # acknowledged with one getlasterror carrying the write concern.  a batch is flushed once
+    # it holds as many ops as flow control allows or is batch_age seconds old.  a batch is
+    # kept until it's acknowledged: if the to host goes away it's sent again in full, which is
+    # safe because oplog entries are idempotent.
+    def __init__(self, toc, flow, batch_age, gle, metrics, verbose):
+        self.toc = toc
+        self.flow = flow
+        self.batch_age = batch_age
+        self.gle = gle
+        self.metrics = metrics
+        self.verbose = verbose
+        self.pending = []
+        self.unacked = 0
+        self.batch_start = None
+        # pin a socket so the unacknowledged writes and the getlasterror share a connection
+        self.toc.start_request()
+
+    def col(self, ns):
+        ns = ns.split('.',1)
+        assert len(ns) == 2
+        return self.toc[ns[0]][ns[1]]
+
+    def insert(self, ns, o):
+        # the server refuses multi-document inserts into system collections, so index builds
+        # (inserts into system.indexes) are sent one at a time
+        if (self.pending and self.pending[-1][0] == 'insert' and self.pending[-1][1] == ns and
+            not ns.split('.',1)[1].startswith('system.')):
+            self.pending[-1][2].append(o)
+        else:
+            self.pending.append(('insert', ns, [o]))
+        self.metrics.op('i')
+        self.added()
+
+    def update(self, ns, o2, o):
+        self.pending.append(('update', ns, (o2, o)))
+        self.metrics.op('u')
+        self.added()
+
+    def remove(self, ns, o):
+        self.pending.append(('remove', ns, o))
+        self.metrics.op('d')
+        self.added()
+
+    def command(self, ns, o):
+        # commands may depend on every earlier write and change what later writes mean
+        self.flush()
+        ns = ns.split('.',1)
         assert len(ns) == 2
+        assert ns[1] == '$cmd'
+        while 1:
+            try:
+                self.toc[ns[0]].command(o)
+                break
+            except AutoReconnect:
+                # the command may or may not have run, so run it again; if it did, it fails
+                # as already applied
+                print("lost to host, resending command", sys.exc_info()[1])
+                self.reconnect()
+            except OperationFailure:
+                if not idempotent_failure(sys.exc_info()[1]):
+                    raise
+                if self.verbose: print("already applied", ns, o, sys.exc_info()[1])
+                break
+        self.metrics.op('c')
+
+    def added(self):
+        self.unacked += 1
+        if self.batch_start is None:
+            self.batch_start = time.time()
+        if self.unacked >= self.flow.batch_size or time.time() - self.batch_start >= self.batch_age:
+            self.flush()
+
+    def send(self):
+        # send the batch unacknowledged.  a multi-document insert stops at its first error,
+        # typically a duplicate key when entries are applied again, and the next write resets
+        # the error getlasterror reports, so each run of inserts with anything after it is
+        # checked on its own.  returns the first error found that way, or None.
+        last = len(self.pending) - 1
+        for i, (kind, ns, args) in enumerate(self.pending):
+            col = self.col(ns)
+            if kind == 'insert':
+                if self.verbose: print("insert", ns, len(args))
+                col.insert(args, w=0)
+                if i < last:
+                    r = self.toc.admin.command('getlasterror')
+                    if r.get('err') is not None:
+                        return r
+            elif kind == 'update':
+                col.update(args[0], args[1], w=0)
+            else:
+                col.remove(args, w=0)
+        return None
+
+    def send_acknowledged(self):
+        # when a write in the batch fails, apply the batch again an op at a time, each
+        # acknowledged.  an insert of a document that's already there replaces it, as it does
+        # when mongod applies its own oplog.
+        for kind, ns, args in self.pending:
+            col = self.col(ns)
+            try:
+                if kind == 'insert':
+                    for o in args:
+                        try:
+                            col.insert(o, w=1)
+                        except DuplicateKeyError:
+                            col.update({'_id': o['_id']}, o, upsert=True, w=1)
+                elif kind == 'update':
+                    col.update(args[0], args[1], w=1)
+                else:
+                    col.remove(args, w=1)
+            except OperationFailure:
+                raise WriteError(kind, ns, args, sys.exc_info()[1])
+
+    def reconnect(self):
+        time.sleep(1)
+        self.toc.end_request()
+        self.toc.start_request()
+
+    def acknowledge(self):
+        # send the batch and getlasterror, again from the start if the to host goes away
+        # before answering, since we can't know how much of the batch it applied
+        while 1:
+            try:
+                r = self.send()
+                if r is None:
+                    r = self.toc.admin.command(self.gle)
+                if r.get('err') is not None and not r.get('wtimeout') and r.get('code') != 64:
+                    print("write error, applying batch again one op at a time", r)
+                    self.send_acknowledged()
+                    r = self.toc.admin.command(self.gle)
+                return r
+            except AutoReconnect:
+                print("lost to host, resending batch", sys.exc_info()[1])
+                self.reconnect()
+
+    def flush(self):
+        # send the batch and wait until the write concern acknowledges all of it
+        if self.unacked:
+            if self.verbose: print("flush", self.unacked)
+            self.flow.acquire()
+            start = time.time()
+            try:
+                r = self.acknowledge()
+            finally:
+                latency = time.time() - start
+                self.flow.release(latency)
+            self.metrics.batch(self.unacked, latency)
+            if r.get('wtimeout') or r.get('code') == 64 or r.get('err') is not None:
+                # the batch isn't acknowledged, so its position mustn't be checkpointed
+                raise WriteConcernError(r)
+            self.pending = []
+            self.unacked = 0
+        self.batch_start = None
+
+class Worker(threading.Thread):
+    # apply ops from a queue with an Applier on the worker's own connection
+    def __init__(self, applier, queue_size):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.applier = applier
+        self.queue = Queue(queue_size)
+        self.error = None
+
+    def run(self):
+        # requests are per thread, so pin this thread's socket
+        self.applier.toc.start_request()
+        while 1:
+            item = self.queue.get()
+            try:
+                if self.error is None:
+                    if item is None:
+                        self.applier.flush()
+                    else:
+                        method, args = item
+                        getattr(self.applier, method)(*args)
+            except:
+                print("worker error", sys.exc_info())
+                self.error = sys.exc_info()[1]
+            finally:
+                self.queue.task_done()
+
+class ParallelApplier(object):
+    # spread ops over one worker per to host connection.  ops are partitioned by ns and _id
+    # hash, so ops on one document stay in order while independent documents are applied
+    # concurrently.  commands are barriers: every worker drains before a command runs.
+    def __init__(self, tocs, flow, batch_age, gle, metrics, verbose):
+        self.workers = [Worker(Applier(toc, flow, batch_age, gle, metrics, verbose), flow.max_batch_size)
+                        for toc in tocs]
+        for w in self.workers:
+            w.start()
+        self.cmd_applier = self.workers[0].applier
+
+    def worker(self, ns, o):
+        _id = o.get('_id')
+        try:
+            h = hash((ns, _id))
+        except TypeError:
+            # embedded documents and arrays aren't hashable
+            h = hash((ns, repr(_id)))
+        return self.workers[h % len(self.workers)]
+
+    def insert(self, ns, o):
+        self.worker(ns, o).queue.put(('insert', (ns, o)))
+
+    def update(self, ns, o2, o):
+        self.worker(ns, o2).queue.put(('update', (ns, o2, o)))
+
+    def remove(self, ns, o):
+        self.worker(ns, o).queue.put(('remove', (ns, o)))
+
+    def command(self, ns, o):
+        self.flush()
+        self.cmd_applier.command(ns, o)
+
+    def flush(self):
+        for w in self.workers:
+            w.queue.put(None)
+        for w in self.workers:
+            w.queue.join()
+        for w in self.workers:
+            if w.error is not None:
+                raise w.error
+
+def replay_tokumx(applier, nsfilter, ops, verbose):
+    for op in ops:
+        op = nsfilter.entry(op)
+        if op is not None:
+            replay_tokumx_op(applier, op, verbose)
+
+def replay_tokumx_op(applier, oploge, verbose):
+    op = oploge['op']
+    ns = oploge.get('ns')   # comments have none
+    if op in ('i', 'ci'):
         o = oploge['o']
-        if verbose: print("delete", ns, o)
-        db = toc[ns[0]]
-        col = db[ns[1]]
-        col.remove(o)
+        if verbose: print("insert", ns, o)
+        applier.insert(ns, o)
     elif op == 'u':
-        ns = oploge['ns'].split('.',1)
-        assert len(ns) == 2
+        # full pre-image in o, full post-image in o2
         o = oploge['o']
         o2 = oploge['o2']
         if verbose: print("update", ns, o, o2)
-        db = toc[ns[0]]
-        col = db[ns[1]]
-        col.update(o2, o)
+        applier.update(ns, { '_id': o['_id'] }, o2)
+    elif op == 'ur':
+        # full pre-image in o, mods to generate the post-image in m.  the mods aren't
+        # idempotent, so match the whole pre-image: once applied, replaying it is a no-op
+        o = oploge['o']
+        m = oploge['m']
+        if verbose: print("update", ns, o, m)
+        applier.update(ns, o, m)
+    elif op in ('d', 'cd'):
+        o = oploge['o']
+        if verbose: print("delete", ns, o)
+        applier.remove(ns, { '_id': o['_id'] })
     elif op == 'c':
-        ns = oploge['ns'].split('.',1)
-        assert len(ns) == 2
-        assert ns[1] == '$cmd'
         o = oploge['o']
         if verbose: print("command", ns, o)
-        db = toc[ns[0]]
-        db.command(o)
+        applier.command(ns, o)
+    elif op == 'n':
+        if verbose: print("nop", oploge)
+    elif op in ('dp', 'ap', 'pi'):
+        # partition ids are local to each server, so partition ops can't be replayed
+        print("unsupported", oploge)
+    else:
+        print("unknown", oploge)
+        assert 0
+
+def replay(applier, op, oploge, verbose):
+    if op == 'i':
+        o = oploge['o']
+        if verbose: print("insert", oploge['ns'], o)
+        applier.insert(oploge['ns'], o)
+    elif op == 'd':
+        o = oploge['o']
+        if verbose: print("delete", oploge['ns'], o)
+        applier.remove(oploge['ns'], o)
+    elif op == 'u':
+        o = oploge['o']
+        o2 = oploge['o2']
+        if verbose: print("update", oploge['ns'], o, o2)
+        applier.update(oploge['ns'], o2, o)
+    elif op == 'c':
+        o = oploge['o']
+        if verbose: print("command", oploge['ns'], o)
+        applier.command(oploge['ns'], o)
     elif op == 'n':
         if verbose: print("nop", oploge)
     else:
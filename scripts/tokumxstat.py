@@ -1,19 +1,112 @@
 #!/usr/bin/env python2
 
-"""tokumxstat.py watches the engineStatus of a TokuMX instance and periodically
-prints when any variables changed, and by how much.  It is typically used for
-monitoring a system.
+"""tokumxstat.py watches the engineStatus of one or more TokuMX instances and
+periodically prints when any variables changed, and by how much.  It is
+typically used for monitoring a system.
+
+With several hosts (or --discover), every host is polled at the same aligned
+instants over its own persistent connection, and each line is tagged with its
+host.
+
+With --record, every sample is also appended to a compact columnar recording,
+one directory per host, for later analysis.  Intervals can be as short as a
+millisecond; rates use the time that actually passed between samples, and each
+sample's round trip time is recorded with it.  --analyze summarizes the rates
+in a host's recording over windows (this needs numpy).  With --compare, it
+instead sets the rates in the --analyze recording (before) side by side with
+those in the --compare one (after), and marks the keys whose mean rate changed
+significantly.
+
+--commands adds the output of other commands to each sample: serverStatus (the
+opcounters, globalLock and per-database locks sections among others) and top.
+They are run one after another in the same pass, flattened into dotted keys
+prefixed with the command's name, and diffed and recorded together with the
+engineStatus keys.
+
+--alert watches a key as each sample arrives and runs --alert-command when a
+rule starts or stops holding.  A rule is "KEY[/s] OP VALUE [for SECS]", where
+/s compares the key's rate instead of its value, OP is one of < <= > >=, and
+"for SECS" means the condition must hold that long before it fires.  VALUE can
+instead be "Nx baseline", which compares against a moving average of the key's
+value (or rate) over --baseline-window seconds.  The baseline starts as the
+average of the first few samples, and while the rule holds it moves ten times
+slower, so a level that persists eventually becomes the new normal.  A baseline
+of zero is never compared against.
+For example:
+
+    --alert "cachetable: evictions/s > 1000 for 30"
+    --alert "checkpoint: time spent during last checkpoint (end - begin) > 3x baseline"
+
+--prometheus serves the latest sample of every host over HTTP in the Prometheus
+text format, and --statsd sends each sample to a statsd server over UDP, as
+deltas for counters and values for gauges.  Whether a key is a counter or a
+gauge comes from the key's schema: integers are counters unless the key's name
+says otherwise, and a counter that ever goes down is treated as a gauge from
+then on.
+
+--live replaces the scrolling output with a full screen view of the keys
+changing fastest, ranked by rate, each with a sparkline of its last --history
+rates.  Press / to filter keys by a regular expression, ended by enter (an empty
+one shows them all again) or escape to cancel, and q to quit.  Sampling goes
+on while a filter is typed.
 """
 
-import collections
+import array
+import calendar
+import ctypes
+import ctypes.util
+import datetime
+import curses
+import json
+import locale
 import logging
+import math
+import operator
+import os
+import Queue
 import re
+import socket
+import struct
+import subprocess
 import sys
+import threading
 import time
 import optparse
+import zlib
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 
 import pymongo
+from pymongo.errors import OperationFailure
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _monotonic_clock():
+    """Returns a function that reads a monotonic clock in seconds.  Python 2
+    has none, so call clock_gettime through ctypes, or fall back to time.time
+    where that isn't available.
+    """
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True)
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+        CLOCK_MONOTONIC = 1
+        def monotonic():
+            ts = timespec()
+            if librt.clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+                raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+        monotonic()
+        return monotonic
+    except (OSError, AttributeError):
+        return time.time
 
+monotonic = _monotonic_clock()
 
 def convert(v):
     if type(v) == type('str'):
@@ -23,79 +116,1290 @@ def convert(v):
             v = float(v)
     return v
 
-def printit(stats, es, sleeptime):
-    logging.info(time.strftime('%c'))
-    od = collections.OrderedDict(sorted(es.items()))
-    
-    for k, v in od.iteritems():
+def identity(v):
+    return v
+
+def parser_for(v):
+    """Picks how to parse a key's values from its first value: engineStatus
+    reports some numbers as strings.
+    """
+    if type(v) == type('str'):
         try:
-            v = convert(v)
-        except:
+            int(v)
+            return int
+        except ValueError:
             pass
-        if stats.has_key(k):
-            oldv = stats[k]
-            if v != oldv:
-                print k, "|", oldv, "|", v,
-                try:
-                    d = v - oldv
-                    if sleeptime != 1:
-                        if d >= sleeptime:
-                            e = d / sleeptime
-                        else:
-                            e = float(d) / sleeptime
-                        print "|", d, "|", e
-                    else:
-                        print "|", d
-                except:
-                    print
-        stats[k] = v
+        try:
+            float(v)
+            return float
+        except ValueError:
+            pass
+    return identity
+
+# the previous value of a key that wasn't in the previous sample
+MISSING = object()
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+# integer keys whose names say they go up and down
+GAUGE_RE = re.compile(r'current|in use|size|limit|max|min|period|last|time of|percent|ratio|'
+                      r'lag|queue|available|active|open|outstanding|now|pending', re.I)
+
+def integral(v):
+    """Whether v is a whole number.  The server's appendNumber sends integers
+    of magnitude 2^30 up to 2^40 as doubles, so a counter can arrive as one.
+    """
+    if isinstance(v, bool):
+        return False
+    if isinstance(v, (int, long)):
+        return True
+    return isinstance(v, float) and not math.isinf(v) and v == math.floor(v)
+
+def kind_for(k, v, parser):
+    """Guesses from a key's name and first value whether it is a counter or a
+    gauge.
+    """
+    if parser is float or isinstance(v, datetime.datetime):
+        return GAUGE
+    if parser is int or integral(v):
+        if GAUGE_RE.search(k):
+            return GAUGE
+        return COUNTER
+    return GAUGE
+
+class Schema(object):
+    """The sorted keys of a host's engineStatus and a parser for each, learned
+    from one sample and reused for every sample after it.
+    """
+
+    def __init__(self, es):
+        self.keys = sorted(es)
+        self.parsers = [parser_for(es[k]) for k in self.keys]
+        self.kinds = [kind_for(k, es[k], p) for k, p in zip(self.keys, self.parsers)]
+        self.index = dict((k, i) for i, k in enumerate(self.keys))
+
+    def parse(self, es, values):
+        """Parses es into the list values.  Returns False if es doesn't have
+        exactly this schema's keys.
+        """
+        if len(es) != len(self.keys):
+            return False
+        parsers = self.parsers
+        for i, k in enumerate(self.keys):
+            try:
+                v = es[k]
+            except KeyError:
+                return False
+            try:
+                values[i] = parsers[i](v)
+            except (ValueError, TypeError):
+                # a key that was a numeric string can come back as None or a document
+                values[i] = v
+        return True
+
+class HostStats(object):
+    """The last two samples from one host, parsed through its Schema into two
+    lists that are swapped and reused on every sample, and when they were
+    taken.  The time between samples comes from the monotonic clock, so a
+    wall clock step doesn't distort rates; wall clock time is only recorded.
+    """
+
+    def __init__(self):
+        self.schema = None
+        self.values = None
+        self.prev = None
+        self.time = None
+        self.clock = None
+        self.elapsed = None
+        self.rtt = None
+
+    def update(self, es, t, clock, rtt):
+        if self.clock is not None:
+            self.elapsed = clock - self.clock
+        self.time = t
+        self.clock = clock
+        self.rtt = rtt
+        self.prev, self.values = self.values, self.prev
+        if self.schema is None or not self.schema.parse(es, self.values):
+            old = {}
+            if self.schema is not None:
+                old = dict(zip(self.schema.keys, self.prev))
+            self.schema = Schema(es)
+            self.prev = [old.get(k, MISSING) for k in self.schema.keys]
+            self.values = [None] * len(self.schema.keys)
+            self.schema.parse(es, self.values)
+
+def printit(hs, tag=None):
+    # rates use the time that actually passed between the two samples
+    elapsed = hs.elapsed
+    keys = hs.schema.keys
+    prev = hs.prev
+    values = hs.values
+    for i in xrange(len(keys)):
+        oldv = prev[i]
+        v = values[i]
+        if oldv is not MISSING and v != oldv:
+            if tag is not None:
+                print tag, "|",
+            print keys[i], "|", oldv, "|", v,
+            try:
+                d = v - oldv
+                print "|", d, "|", d / elapsed
+            except:
+                print
     print
 
-def main():
-    parser = optparse.OptionParser(usage="usage: %prog [options] <host:port>\n\n" + __doc__)
-    parser.add_option("-s", "--sleeptime", dest="sleeptime", default=10, type=int,
-                      help="duration to sleep between reports [default: %default]", metavar="TIME")
-    (opts, args) = parser.parse_args()
-    if len(args) > 1:
-        parser.error("too many arguments")
-    if opts.sleeptime < 1:
-        parser.error("invalid --sleeptime: %d" % opts.sleeptime)
+def discover(host):
+    """Returns the set of hosts to poll starting from host: the members of its
+    replica set, or for a mongos, the members of every shard.  Arbiters are
+    skipped, they have no data.
+    """
+    client = pymongo.MongoClient(host)
+    try:
+        im = client.admin.command('isMaster')
+        if im.get('msg') == 'isdbgrid':
+            hosts = set()
+            for shard in client.admin.command('listShards')['shards']:
+                # shard hosts look like "rsname/host1,host2" or just "host"
+                for h in shard['host'].split('/')[-1].split(','):
+                    hosts |= discover(h)
+            return hosts
+        hosts = set([host])
+        hosts.update(im.get('hosts', []))
+        hosts.update(im.get('passives', []))
+        try:
+            rs = client.admin.command('replSetGetStatus')
+            for m in rs['members']:
+                if m.get('stateStr') != 'ARBITER':
+                    hosts.add(m['name'])
+        except OperationFailure:
+            pass
+        return hosts
+    finally:
+        client.close()
 
-    logging.basicConfig(level=logging.INFO)
+def flatten(doc, prefix, out):
+    """Copies the values in the nested document doc into out, keyed by their
+    dotted paths under prefix.  Arrays are skipped, there's nothing stable to
+    key their elements by.
+    """
+    for k, v in doc.iteritems():
+        key = prefix + '.' + k
+        if isinstance(v, dict):
+            flatten(v, key, out)
+        elif not isinstance(v, list):
+            out[key] = v
+
+def sample_engine_status(client):
+    return client['test'].command('engineStatus')
+
+def sample_server_status(client):
+    ss = client.admin.command('serverStatus')
+    # the sample has its own time
+    ss.pop('localTime', None)
+    ss.pop('ok', None)
+    out = {}
+    flatten(ss, 'serverStatus', out)
+    return out
+
+def sample_top(client):
+    totals = client.admin.command('top')['totals']
+    totals.pop('note', None)
+    out = {}
+    flatten(totals, 'top', out)
+    return out
 
-    host = "localhost:27017"
-    if len(args) == 1:
-        host = args[0]
+# The commands --commands can pick from.  Each takes a connection and returns a
+# flat document; engineStatus keys keep their names so older recordings line up.
+SAMPLERS = {
+    'engineStatus': sample_engine_status,
+    'serverStatus': sample_server_status,
+    'top': sample_top,
+}
 
+# Recording format: a directory per host holding schema.json, which lists the
+# columns (one per engineStatus key, in the order they were first seen, so a
+# key's index never changes, plus RTT_KEY for each sample's round trip time)
+# and their type codes, and numbered block files.
+# A block is zlib compressed: a header, the sample times as float64, then one
+# array per column.  Integer columns are stored as deltas from the previous
+# sample, which turns slowly moving counters into runs of small numbers that
+# compress very well.
+BLOCK_MAGIC = 'TKS1'
+BLOCK_HEADER = struct.Struct('<4sII')
+BLOCK_RE = re.compile(r'block\.(\d+)$')
+RTT_KEY = 'tokumxstat: sample round trip time'
+
+FLOAT64 = 'd'
+try:
+    INT64 = array.array('q').typecode
+except ValueError:
+    # python 2 has no 'q', but long is 64 bits everywhere TokuMX runs
+    INT64 = 'l'
+assert array.array(INT64).itemsize == 8
+
+def numeric(v):
+    """Returns v as an int or float, or None if it isn't a number."""
+    if isinstance(v, datetime.datetime):
+        return calendar.timegm(v.utctimetuple())
+    if isinstance(v, bool):
+        return int(v)
     try:
-        logging.debug('connecting to %s...', host)
-        client = pymongo.MongoClient(host)
-        db = client['test']
+        v = convert(v)
     except:
-        logging.exception('error connecting to %s', host)
-        return 1
+        return None
+    if isinstance(v, (int, long, float)):
+        return v
+    return None
+
+class Recorder(object):
+    """Appends every sample of one host to a columnar recording in dirname."""
+
+    def __init__(self, dirname, block_samples):
+        self.dirname = dirname
+        self.block_samples = block_samples
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.columns = []
+        self.types = []
+        schema = os.path.join(dirname, 'schema.json')
+        if os.path.exists(schema):
+            f = open(schema)
+            try:
+                s = json.load(f)
+            finally:
+                f.close()
+            self.columns = s['columns']
+            self.types = [str(t) for t in s['types']]
+        self.index = dict((k, i) for i, k in enumerate(self.columns))
+        self.last = [0] * len(self.columns)
+        self.schema = None
+        self.mapping = []
+        self.seq = 0
+        for name in os.listdir(dirname):
+            match = BLOCK_RE.match(name)
+            if match:
+                self.seq = max(self.seq, int(match.group(1)) + 1)
+        self.new_block()
+        self.rtt_col = self.index.get(RTT_KEY)
+        if self.rtt_col is None:
+            self.rtt_col = self.add_column(RTT_KEY, 0.0, 0)
+
+    def new_block(self):
+        self.times = array.array(FLOAT64)
+        self.data = [array.array(t) for t in self.types]
+
+    def add_column(self, k, v, n):
+        i = len(self.columns)
+        self.columns.append(k)
+        self.index[k] = i
+        t = isinstance(v, float) and FLOAT64 or INT64
+        self.types.append(t)
+        self.last.append(0)
+        # the n earlier samples in this block didn't have it
+        self.data.append(array.array(t, [0] * n))
+        self.write_schema()
+        return i
+
+    def write_schema(self):
+        path = os.path.join(self.dirname, 'schema.json')
+        f = open(path + '.tmp', 'w')
+        try:
+            json.dump({'columns': self.columns, 'types': self.types}, f)
+        finally:
+            f.close()
+        os.rename(path + '.tmp', path)
+
+    def map_schema(self, schema, values):
+        # which column each of the schema's numeric keys goes to, and whether
+        # it is a date that needs converting
+        self.schema = schema
+        self.mapping = []
+        for i, k in enumerate(schema.keys):
+            v = values[i]
+            nv = numeric(v)
+            if nv is None:
+                continue
+            col = self.index.get(k)
+            if col is None:
+                col = self.add_column(k, nv, len(self.times))
+            self.mapping.append((i, col, isinstance(v, datetime.datetime)))
+
+    def append(self, t, rtt, schema, values):
+        if schema is not self.schema:
+            self.map_schema(schema, values)
+        n = len(self.times)
+        self.times.append(t)
+        data = self.data
+        data[self.rtt_col].append(rtt)
+        for i, col, isdate in self.mapping:
+            v = values[i]
+            if isdate:
+                v = calendar.timegm(v.utctimetuple())
+            try:
+                data[col].append(v)
+            except TypeError:
+                # a float in an int column, or a value that stopped being a number
+                v = numeric(v)
+                if v is not None:
+                    data[col].append(self.types[col] == INT64 and int(v) or float(v))
+        # keys missing from this sample repeat their last value
+        for i, a in enumerate(data):
+            if len(a) == n:
+                a.append(a[-1] if n else self.last[i])
+        if len(self.times) >= self.block_samples:
+            self.flush()
+
+    def flush(self):
+        if not len(self.times):
+            return
+        parts = [BLOCK_HEADER.pack(BLOCK_MAGIC, len(self.times), len(self.columns)),
+                 self.times.tostring()]
+        for t, a in zip(self.types, self.data):
+            if t == INT64:
+                a = delta(a)
+            parts.append(a.tostring())
+        self.last = [a[-1] for a in self.data]
+        path = os.path.join(self.dirname, 'block.%06d' % self.seq)
+        f = open(path + '.tmp', 'wb')
+        try:
+            f.write(zlib.compress(''.join(parts)))
+        finally:
+            f.close()
+        os.rename(path + '.tmp', path)
+        self.seq += 1
+        self.new_block()
 
-    logging.info('connected to %s', host)
+def delta(a):
+    if numpy is not None:
+        v = numpy.frombuffer(a, dtype=numpy.int64)
+        d = v.copy()
+        d[1:] -= v[:-1]
+        return array.array(a.typecode, d.tostring())
+    d = array.array(a.typecode, a)
+    for i in xrange(len(a) - 1, 0, -1):
+        d[i] -= d[i - 1]
+    return d
 
-    stats = {}
+def undelta(a):
+    # a week of samples is hundreds of thousands of elements per column, which
+    # numpy sums in one pass instead of one interpreted step each
+    if numpy is not None:
+        s = numpy.cumsum(numpy.frombuffer(a, dtype=numpy.int64))
+        return array.array(a.typecode, s.tostring())
+    a = array.array(a.typecode, a)
+    for i in xrange(1, len(a)):
+        a[i] += a[i - 1]
+    return a
+
+def read_recording(dirname):
+    """Loads a host's recording.  Returns (columns, types, times, data), where
+    times is an array of sample times and data holds one array per column.
+    Columns added after a block was written read as 0 in that block.
+    """
+    f = open(os.path.join(dirname, 'schema.json'))
     try:
+        s = json.load(f)
+    finally:
+        f.close()
+    columns = s['columns']
+    types = [str(t) for t in s['types']]
+    times = array.array(FLOAT64)
+    data = [array.array(t) for t in types]
+    names = [name for name in os.listdir(dirname) if BLOCK_RE.match(name)]
+    names.sort(key=lambda name: int(BLOCK_RE.match(name).group(1)))
+    for name in names:
+        f = open(os.path.join(dirname, name), 'rb')
+        try:
+            buf = zlib.decompress(f.read())
+        finally:
+            f.close()
+        magic, n, ncols = BLOCK_HEADER.unpack_from(buf)
+        if magic != BLOCK_MAGIC:
+            raise ValueError('%s is not a recording block' % name)
+        off = BLOCK_HEADER.size
+        times.fromstring(buf[off:off + 8 * n])
+        off += 8 * n
+        for i in xrange(len(columns)):
+            a = array.array(types[i])
+            if i < ncols:
+                a.fromstring(buf[off:off + 8 * n])
+                off += 8 * n
+                if types[i] == INT64:
+                    a = undelta(a)
+            else:
+                a.extend([0] * n)
+            data[i].extend(a)
+    return columns, types, times, data
+
+def load_matrix(dirname):
+    """Loads a host's recording as (columns, times, values), values being a
+    samples x columns float64 matrix.
+    """
+    columns, types, times, data = read_recording(dirname)
+    t = numpy.frombuffer(times, dtype=numpy.float64)
+    x = numpy.empty((len(t), len(columns)))
+    for i, a in enumerate(data):
+        if types[i] == INT64:
+            x[:, i] = numpy.frombuffer(a, dtype=numpy.int64)
+        else:
+            x[:, i] = numpy.frombuffer(a, dtype=numpy.float64)
+    return columns, t, x
+
+def rates(t, x):
+    """Per second rates of every column between consecutive samples, using the
+    actual time between them.  Returns (times, rates); samples that don't move
+    forward in time (a restarted recording) are dropped.
+    """
+    dt = numpy.diff(t)
+    r = numpy.diff(x, axis=0) / numpy.where(dt > 0, dt, 1)[:, numpy.newaxis]
+    keep = dt > 0
+    return t[1:][keep], r[keep]
+
+def moving_average(r, n):
+    """Moving average of the rows of r over n samples, for every column at once."""
+    n = max(1, min(n, len(r)))
+    c = numpy.cumsum(numpy.vstack([numpy.zeros((1, r.shape[1])), r]), axis=0)
+    return (c[n:] - c[:-n]) / n
+
+def window_stats(t, r, window):
+    """Splits the rates into windows of `window` seconds and returns (starts,
+    mean, min, max, p50, p99), each statistic a windows x columns matrix.
+    """
+    w = numpy.floor((t - t[0]) / window).astype(numpy.int64)
+    starts = numpy.concatenate([[0], numpy.flatnonzero(numpy.diff(w)) + 1])
+    counts = numpy.diff(numpy.concatenate([starts, [len(t)]]))
+    mean = numpy.add.reduceat(r, starts, axis=0) / counts[:, numpy.newaxis]
+    lo = numpy.minimum.reduceat(r, starts, axis=0)
+    hi = numpy.maximum.reduceat(r, starts, axis=0)
+    p50 = numpy.empty_like(mean)
+    p99 = numpy.empty_like(mean)
+    for i, chunk in enumerate(numpy.split(r, starts[1:])):
+        p50[i], p99[i] = numpy.percentile(chunk, [50, 99], axis=0)
+    return t[starts], mean, lo, hi, p50, p99
+
+def analyze(dirname, window, pattern, per_window):
+    if numpy is None:
+        logging.error('--analyze needs numpy')
+        return 1
+    columns, t, x = load_matrix(dirname)
+    if len(t) < 2:
+        logging.error('%s has fewer than two samples', dirname)
+        return 1
+    rt, r = rates(t, x)
+    selected = [i for i, k in enumerate(columns)
+                if k != RTT_KEY and (pattern is None or pattern.search(k)) and numpy.any(r[:, i] != 0)]
+    if not selected:
+        return 0
+    r = r[:, selected]
+    columns = [columns[i] for i in selected]
+
+    p50, p99 = numpy.percentile(r, [50, 99], axis=0)
+    interval = numpy.median(numpy.diff(rt)) if len(rt) > 1 else window
+    ma = moving_average(r, int(round(window / interval)))
+    # a stall shows up as the lowest moving average, a burst as the highest
+    low = numpy.argmin(ma, axis=0)
+    peak = numpy.argmax(ma, axis=0)
+    print "key | mean/s | min/s | max/s | p50/s | p99/s | low %ds avg/s | low at | peak %ds avg/s | peak at" % (window, window)
+    for i, k in enumerate(columns):
+        print k, "|", r[:, i].mean(), "|", r[:, i].min(), "|", r[:, i].max(), "|", p50[i], "|", p99[i], "|", \
+            ma[low[i], i], "|", time.strftime('%c', time.localtime(rt[low[i]])), "|", \
+            ma[peak[i], i], "|", time.strftime('%c', time.localtime(rt[peak[i]]))
+
+    if per_window:
+        starts, mean, lo, hi, wp50, wp99 = window_stats(rt, r, window)
+        for w in xrange(len(starts)):
+            print
+            logging.info(time.strftime('%c', time.localtime(starts[w])))
+            for i, k in enumerate(columns):
+                if hi[w, i] != 0 or lo[w, i] != 0:
+                    print k, "|", mean[w, i], "|", lo[w, i], "|", hi[w, i], "|", wp50[w, i], "|", wp99[w, i]
+    return 0
+
+ALERT_RE = re.compile(r'^(?P<key>.+?)(?P<rate>/s)?\s*(?P<op><=|>=|<|>)\s*'
+                      r'(?P<value>[-+0-9.eE]+)(?P<baseline>x\s*baseline)?'
+                      r'(?:\s+for\s+(?P<duration>[0-9.]+)s?)?\s*$')
+ALERT_OPS = {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+
+class Rule(object):
+    """One --alert rule, parsed from its text.  Raises ValueError if the text
+    isn't a rule.
+    """
+
+    def __init__(self, text):
+        match = ALERT_RE.match(text)
+        if not match:
+            raise ValueError('invalid alert rule: %s' % text)
+        self.text = text
+        self.key = match.group('key').strip()
+        self.rate = match.group('rate') is not None
+        self.op = ALERT_OPS[match.group('op')]
+        self.value = float(match.group('value'))
+        self.baseline = match.group('baseline') is not None
+        self.duration = float(match.group('duration') or 0)
+
+# samples averaged into a baseline before anything is compared against it
+BASELINE_WARMUP = 5
+# a baseline this close to zero makes any nonzero value look like a huge jump
+BASELINE_MIN = 1e-9
+# how much slower the baseline follows values that make the rule hold
+BASELINE_HOLDING_RATE = 0.1
+
+class AlertState(object):
+    """What one rule remembers about one host between samples."""
+    __slots__ = ('since', 'firing', 'baseline', 'samples')
+
+    def __init__(self):
+        self.since = None
+        self.firing = False
+        self.baseline = None
+        self.samples = 0
+
+class Alerter(object):
+    """Evaluates the rules against each host's latest sample, keeping a fixed
+    amount of state per rule and host, and runs command (through the shell,
+    without waiting for it) whenever a rule fires or resolves.  The command
+    gets the details in TOKUMXSTAT_* environment variables.
+    """
+
+    def __init__(self, rules, command, baseline_window):
+        self.rules = rules
+        self.command = command
+        self.baseline_window = baseline_window
+        self.states = {}
+        self.children = []
+
+    def sample_value(self, rule, hs):
+        i = hs.schema.index.get(rule.key)
+        if i is None:
+            return None
+        v = numeric(hs.values[i])
+        if not rule.rate or v is None:
+            return v
+        if hs.prev is None or not hs.elapsed:
+            return None
+        oldv = numeric(hs.prev[i])
+        if oldv is None:
+            return None
+        return (v - oldv) / hs.elapsed
+
+    def check(self, host, hs):
+        for rule in self.rules:
+            v = self.sample_value(rule, hs)
+            if v is None:
+                continue
+            state = self.states.get((host, rule))
+            if state is None:
+                state = self.states[(host, rule)] = AlertState()
+            if rule.baseline:
+                if state.samples < BASELINE_WARMUP:
+                    state.samples += 1
+                    if state.baseline is None:
+                        state.baseline = float(v)
+                    else:
+                        state.baseline += (v - state.baseline) / state.samples
+                    continue
+                holds = abs(state.baseline) > BASELINE_MIN and rule.op(v, rule.value * state.baseline)
+                # an exponential moving average, so it's one number however long the window
+                alpha = min(1.0, (hs.elapsed or 0) / self.baseline_window)
+                if holds:
+                    alpha *= BASELINE_HOLDING_RATE
+                state.baseline += alpha * (v - state.baseline)
+            else:
+                holds = rule.op(v, rule.value)
+            if not holds:
+                state.since = None
+                if state.firing:
+                    state.firing = False
+                    self.notify(host, rule, 'resolved', v, hs.time)
+            elif state.since is None:
+                state.since = hs.clock
+            if holds and not state.firing and hs.clock - state.since >= rule.duration:
+                state.firing = True
+                self.notify(host, rule, 'firing', v, hs.time)
+        self.children = [c for c in self.children if c.poll() is None]
+
+    def notify(self, host, rule, status, v, t):
+        logging.warning('alert %s on %s: %s (%s)', status, host, rule.text, v)
+        if self.command is None:
+            return
+        env = dict(os.environ)
+        env.update({'TOKUMXSTAT_HOST': host,
+                    'TOKUMXSTAT_RULE': rule.text,
+                    'TOKUMXSTAT_STATUS': status,
+                    'TOKUMXSTAT_VALUE': repr(v),
+                    'TOKUMXSTAT_TIME': repr(t)})
+        try:
+            self.children.append(subprocess.Popen(self.command, shell=True, env=env))
+        except OSError:
+            logging.exception('error running alert command')
+
+def metric_name(k, sep='_'):
+    """Makes a key into a name Prometheus (or with sep='.', statsd) accepts."""
+    return sep.join(w for w in re.split(r'[^a-zA-Z0-9]+', k.lower()) if w)
+
+def label_value(v):
+    return v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_number(v):
+    """Formats v for statsd and Prometheus: whole numbers as plain integers,
+    whether they came as ints, longs (whose repr ends in L) or doubles, and
+    everything else as a float.  Returns None for NaN and infinities.
+    """
+    if math.isnan(v) or math.isinf(v):
+        return None
+    # doubles are whole beyond 2^53 but too imprecise to print as integers
+    if isinstance(v, (int, long)) or integral(v) and abs(v) < 2 ** 53:
+        return '%d' % v
+    return repr(float(v))
+
+class Exporter(object):
+    """Keeps the latest numeric values of every host for the Prometheus
+    endpoint, which renders them on each scrape, and sends every sample to
+    statsd if there is one.
+    """
+
+    # keep datagrams under a typical MTU
+    STATSD_PACKET = 1400
+
+    def __init__(self, statsd):
+        self.lock = threading.Lock()
+        self.latest = {}
+        # the metrics of each host's current schema, and the counters seen going down
+        self.metrics = {}
+        self.demoted = set()
+        self.statsd = statsd
+        self.sock = None
+        if statsd is not None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def map_schema(self, host, schema):
+        names = set()
+        metrics = []
+        for i, k in enumerate(schema.keys):
+            name = 'tokumx_' + metric_name(k)
+            if schema.kinds[i] == COUNTER:
+                name += '_total'
+            # two keys can sanitize to the same name, keep the first
+            if name in names:
+                continue
+            names.add(name)
+            metrics.append((i, k, name, schema.kinds[i]))
+        self.metrics[host] = (schema, metrics)
+        return metrics
+
+    def update(self, host, hs):
+        schema, metrics = self.metrics.get(host, (None, None))
+        if schema is not hs.schema:
+            metrics = self.map_schema(host, hs.schema)
+        latest = []
+        lines = []
+        prefix = 'tokumx.' + metric_name(host, '.') + '.'
+        for i, k, name, kind in metrics:
+            v = numeric(hs.values[i])
+            if v is None:
+                continue
+            oldv = None
+            if hs.prev is not None:
+                oldv = numeric(hs.prev[i])
+            if kind == COUNTER and oldv is not None and v < oldv:
+                self.demoted.add((host, k))
+            if kind == COUNTER and (host, k) in self.demoted:
+                kind = GAUGE
+                name = name[:-len('_total')]
+            latest.append((name, kind, v))
+            if self.sock is None:
+                continue
+            if kind == GAUGE:
+                text = format_number(v)
+                if text is not None:
+                    lines.append('%s%s:%s|g' % (prefix, metric_name(k, '.'), text))
+            elif oldv is not None and v != oldv:
+                text = format_number(v - oldv)
+                if text is not None:
+                    lines.append('%s%s:%s|c' % (prefix, metric_name(k, '.'), text))
+        self.lock.acquire()
+        try:
+            self.latest[host] = latest
+        finally:
+            self.lock.release()
+        if lines:
+            self.send_statsd(lines)
+
+    def send_statsd(self, lines):
+        packet = []
+        size = 0
+        for line in lines:
+            if packet and size + len(line) + 1 > self.STATSD_PACKET:
+                self.send_packet('\n'.join(packet))
+                packet = []
+                size = 0
+            packet.append(line)
+            size += len(line) + 1
+        self.send_packet('\n'.join(packet))
+
+    def send_packet(self, packet):
+        try:
+            self.sock.sendto(packet, self.statsd)
+        except socket.error:
+            logging.exception('error sending to statsd at %s:%d', *self.statsd)
+
+    def render(self):
+        """Returns the latest values of every host in the Prometheus text format."""
+        self.lock.acquire()
+        try:
+            latest = sorted(self.latest.items())
+        finally:
+            self.lock.release()
+        series = {}
+        for host, metrics in latest:
+            label = '{host="%s"}' % label_value(host)
+            for name, kind, v in metrics:
+                text = format_number(v)
+                if text is None:
+                    # which Prometheus spells out
+                    text = math.isnan(v) and 'NaN' or v > 0 and '+Inf' or '-Inf'
+                series.setdefault((name, kind), []).append('%s%s %s' % (name, label, text))
+        out = []
+        for (name, kind), lines in sorted(series.iteritems()):
+            out.append('# TYPE %s %s' % (name, kind))
+            out.extend(lines)
+        out.append('')
+        return '\n'.join(out)
+
+def start_prometheus(exporter, address, port):
+    # serve the exporter's latest values on address:port, any path will do
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = exporter.render()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args):
+            pass
+    server = HTTPServer((address, port), Handler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+
+def parse_address(value, default_host):
+    """Splits [HOST:]PORT.  Raises ValueError if PORT isn't a number."""
+    host, sep, port = value.rpartition(':')
+    return host or default_host, int(port)
+
+SPARKS = u' \u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588'
+ASCII_SPARKS = ' .:-=+*#%@'
+
+class Row(object):
+    """One key of one host on the dashboard: its latest rate and a ring buffer
+    of the ones before it.
+    """
+    __slots__ = ('label', 'rate', 'history', 'pos')
+
+    def __init__(self, label, size):
+        self.label = label
+        self.rate = 0.0
+        self.history = array.array('d', [0.0] * size)
+        self.pos = 0
+
+    def push(self, rate):
+        self.rate = rate
+        self.history[self.pos] = rate
+        self.pos = (self.pos + 1) % len(self.history)
+
+    def sparkline(self, sparks, n):
+        """The last n rates, scaled between their min and max."""
+        h = self.history
+        ordered = (h[self.pos:] + h[:self.pos])[-n:]
+        lo = min(ordered)
+        span = max(ordered) - lo
+        if span == 0:
+            return sparks[0] * len(ordered)
+        top = len(sparks) - 1
+        return ''.join(sparks[int((v - lo) / span * top)] for v in ordered)
+
+class StatusHandler(logging.Handler):
+    """Keeps the last log message for the dashboard's status line, since
+    anything written to the terminal would scribble over the screen.
+    """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.message = ''
+
+    def emit(self, record):
+        self.message = self.format(record)
+
+class Dashboard(object):
+    """The --live view.  Only lines whose text changed since the last draw are
+    rewritten, and curses sends just the cells that differ, so it's cheap over
+    a slow link.
+    """
+
+    def __init__(self, history, pattern, tagged):
+        self.history = history
+        self.pattern = pattern
+        self.tagged = tagged
+        self.rows = {}
+        self.shown = []
+        # the filter being typed after /, or None
+        self.typing = None
+        self.status = StatusHandler()
+        self.status.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+        root = logging.getLogger()
+        self.handlers = root.handlers[:]
+        for h in self.handlers:
+            root.removeHandler(h)
+        root.addHandler(self.status)
+        locale.setlocale(locale.LC_ALL, '')
+        self.encoding = locale.getpreferredencoding()
+        self.sparks = ASCII_SPARKS
+        if self.encoding.lower().replace('-', '') == 'utf8':
+            self.sparks = SPARKS
+        self.screen = curses.initscr()
+        curses.noecho()
+        curses.cbreak()
+        self.screen.keypad(1)
+        try:
+            curses.curs_set(0)
+        except curses.error:
+            pass
+
+    def close(self):
+        self.screen.keypad(0)
+        curses.nocbreak()
+        curses.echo()
+        curses.endwin()
+        root = logging.getLogger()
+        root.removeHandler(self.status)
+        for h in self.handlers:
+            root.addHandler(h)
+
+    def update(self, host, hs):
+        if hs.prev is None or not hs.elapsed:
+            return
+        keys = hs.schema.keys
+        for i in xrange(len(keys)):
+            v = numeric(hs.values[i])
+            oldv = numeric(hs.prev[i])
+            if v is None or oldv is None:
+                continue
+            row = self.rows.get((host, keys[i]))
+            if row is None:
+                label = self.tagged and '%s | %s' % (host, keys[i]) or keys[i]
+                row = self.rows[(host, keys[i])] = Row(label, self.history)
+            row.push((v - oldv) / hs.elapsed)
+
+    def draw(self, t):
+        height, width = self.screen.getmaxyx()
+        rows = [r for r in self.rows.itervalues()
+                if r.rate != 0 and (self.pattern is None or self.pattern.search(r.label))]
+        rows.sort(key=lambda r: -abs(r.rate))
+        header = '%s  %d of %d keys changing%s' % (
+            time.strftime('%c', time.localtime(t)), len(rows), len(self.rows),
+            self.pattern is not None and '  /%s/' % self.pattern.pattern or '')
+        lines = [header, '']
+        # the sparklines get at most a third of the screen
+        sparkw = min(self.history, max(8, width // 3))
+        labelw = max(10, width - sparkw - 18)
+        for r in rows[:max(0, height - 3)]:
+            label = r.label
+            if len(label) > labelw:
+                label = label[:labelw - 1] + '~'
+            lines.append('%-*s %14.6g  %s' % (labelw, label, r.rate, r.sparkline(self.sparks, sparkw)))
+        while len(lines) < height - 1:
+            lines.append('')
+        lines.append(self.bottom_line())
+        for y, line in enumerate(lines[:height]):
+            if y < len(self.shown) and self.shown[y] == line:
+                continue
+            self.put(y, line, width)
+        self.shown = lines[:height]
+        self.screen.noutrefresh()
+        curses.doupdate()
+
+    def put(self, y, line, width):
+        if isinstance(line, unicode):
+            text = line[:width - 1].encode(self.encoding, 'replace')
+        else:
+            text = line[:width - 1]
+        try:
+            self.screen.move(y, 0)
+            self.screen.clrtoeol()
+            self.screen.addstr(y, 0, text)
+        except curses.error:
+            pass
+
+    def bottom_line(self):
+        if self.typing is not None:
+            return '/' + self.typing
+        return self.status.message
+
+    def wait(self, delay):
+        """Handles keys until delay seconds have passed.  Raises
+        KeyboardInterrupt on q.  A filter is typed a key at a time here too,
+        so sampling doesn't stop while the operator types.
+        """
+        deadline = monotonic() + delay
         while 1:
+            left = deadline - monotonic()
+            if left <= 0:
+                return
+            self.screen.timeout(max(1, int(left * 1000)))
+            c = self.screen.getch()
+            if c == -1:
+                continue
+            if c == curses.KEY_RESIZE:
+                self.shown = []
+            elif self.typing is not None:
+                self.typed(c)
+            elif c == ord('q'):
+                raise KeyboardInterrupt
+            elif c == ord('/'):
+                self.typing = ''
+                self.draw_bottom_line()
+
+    def typed(self, c):
+        # enter applies the filter (an empty one shows every key), escape drops it
+        if c in (curses.KEY_ENTER, 10, 13):
+            text, self.typing = self.typing, None
+            self.shown = []
+            if not text:
+                self.pattern = None
+            else:
+                try:
+                    self.pattern = re.compile(text)
+                except re.error, e:
+                    logging.warning('bad filter %s: %s', text, e)
+        elif c == 27:
+            self.typing = None
+        elif c in (curses.KEY_BACKSPACE, 127, 8):
+            self.typing = self.typing[:-1]
+        elif 32 <= c < 127:
+            self.typing += chr(c)
+        self.draw_bottom_line()
+
+    def draw_bottom_line(self):
+        height, width = self.screen.getmaxyx()
+        line = self.bottom_line()
+        self.put(height - 1, line, width)
+        if len(self.shown) == height:
+            self.shown[-1] = line
+        self.screen.noutrefresh()
+        curses.doupdate()
+
+def welch(a, b):
+    """Welch's t test of whether a and b have different means.  Returns (t, p),
+    p from the normal approximation, which is close enough with a few dozen
+    windows a side.
+    """
+    diff = b.mean() - a.mean()
+    se = math.sqrt(a.var(ddof=1) / len(a) + b.var(ddof=1) / len(b))
+    if se == 0:
+        if diff == 0:
+            return 0.0, 1.0
+        return math.copysign(float('inf'), diff), 0.0
+    t = diff / se
+    return t, math.erfc(abs(t) / math.sqrt(2))
+
+def compare(before, after, window, pattern, alpha):
+    if numpy is None:
+        logging.error('--compare needs numpy')
+        return 1
+    sides = []
+    for dirname in (before, after):
+        columns, t, x = load_matrix(dirname)
+        if len(t) < 3:
+            logging.error('%s has fewer than three samples', dirname)
+            return 1
+        rt, r = rates(t, x)
+        # consecutive rates are far from independent, so test the window
+        # means, unless there are too few windows to
+        means = window_stats(rt, r, window)[1]
+        if len(means) < 2:
+            logging.warning('%s is shorter than two windows, comparing single samples', dirname)
+            means = r
+        sides.append((dict((k, i) for i, k in enumerate(columns)), r, means))
+    (ia, ra, ma), (ib, rb, mb) = sides
+
+    rows = []
+    for k in sorted(ia):
+        if k == RTT_KEY or k not in ib or (pattern is not None and not pattern.search(k)):
+            continue
+        a = ra[:, ia[k]]
+        b = rb[:, ib[k]]
+        if not a.any() and not b.any():
+            continue
+        t, p = welch(ma[:, ia[k]], mb[:, ib[k]])
+        if a.mean():
+            change = '%+.1f%%' % ((b.mean() - a.mean()) / abs(a.mean()) * 100)
+        else:
+            change = 'new'
+        rows.append((p, -abs(t), k, a, b, change))
+    # most significant first
+    rows.sort()
+
+    print "key | before mean/s | after mean/s | change | before p50/s | after p50/s | before p99/s | after p99/s | p | significant"
+    for p, _, k, a, b, change in rows:
+        pa50, pa99 = numpy.percentile(a, [50, 99])
+        pb50, pb99 = numpy.percentile(b, [50, 99])
+        print k, "|", a.mean(), "|", b.mean(), "|", change, "|", pa50, "|", pb50, "|", pa99, "|", pb99, "|", \
+            "%.3g" % p, "|", p < alpha and "*" or ""
+    return 0
+
+class Poller(threading.Thread):
+    """Runs the samplers on one host, over a connection kept open between
+    samples, each time the main loop hands it a tick, and merges their output
+    into one sample.  Results go to a queue shared by all pollers.  A host
+    slower than the interval skips the ticks it missed rather than working
+    through a backlog of them.
+    """
+
+    def __init__(self, host, samplers, results):
+        threading.Thread.__init__(self, name=host)
+        self.daemon = True
+        self.host = host
+        self.samplers = samplers
+        self.results = results
+        # holds only the newest tick not yet taken
+        self.ticks = Queue.Queue(1)
+        self.client = None
+
+    def tick(self, tick):
+        """Hands the poller a tick, replacing one it hasn't started on yet.
+        Only the main loop calls this, so the queue has room after the get.
+        """
+        try:
+            self.ticks.get_nowait()
+        except Queue.Empty:
+            pass
+        self.ticks.put_nowait(tick)
+
+    def run(self):
+        while True:
+            tick = self.ticks.get()
             try:
-                es = db.command('engineStatus')
+                if self.client is None:
+                    logging.debug('connecting to %s...', self.host)
+                    self.client = pymongo.MongoClient(self.host)
+                    logging.info('connected to %s', self.host)
+                start = monotonic()
+                t = time.time()
+                es = {}
+                for sampler in self.samplers:
+                    es.update(sampler(self.client))
+                rtt = monotonic() - start
+                # the server most likely took the sample halfway through the round trip
+                t += rtt / 2
+                clock = start + rtt / 2
             except:
-                logging.exception('error running engineStatus command')
-                return 2
+                logging.exception('error sampling %s', self.host)
+                # reconnect on the next tick
+                self.client = None
+                es = t = clock = rtt = None
+            self.results.put((self.host, tick, es, t, clock, rtt))
 
+def main():
+    parser = optparse.OptionParser(usage="usage: %prog [options] <host:port> [<host:port> ...]\n\n" + __doc__)
+    parser.add_option("-s", "--sleeptime", dest="sleeptime", default=10, type=float,
+                      help="seconds between reports, down to 0.001 [default: %default]", metavar="TIME")
+    parser.add_option("-d", "--discover", dest="discover", default=False, action="store_true",
+                      help="also poll the other replica set members, or for a mongos, the shards' members")
+    parser.add_option("-c", "--commands", dest="commands", default="engineStatus",
+                      help="comma separated commands to sample, from %s [default: %%default]" % ', '.join(sorted(SAMPLERS)),
+                      metavar="LIST")
+    parser.add_option("-r", "--record", dest="record", default=None,
+                      help="append every sample to a recording in DIR", metavar="DIR")
+    parser.add_option("--block-samples", dest="block_samples", default=600, type=int,
+                      help="samples per recording block [default: %default]", metavar="N")
+    parser.add_option("-a", "--analyze", dest="analyze", default=None,
+                      help="summarize the counter rates in a host's recording DIR instead of polling", metavar="DIR")
+    parser.add_option("--compare", dest="compare", default=None,
+                      help="with --analyze, compare its recording to the one in DIR", metavar="DIR")
+    parser.add_option("--alpha", dest="alpha", default=0.01, type=float,
+                      help="significance level for --compare [default: %default]", metavar="P")
+    parser.add_option("-w", "--window", dest="window", default=60, type=float,
+                      help="analysis window in seconds [default: %default]", metavar="SECS")
+    parser.add_option("-k", "--keys", dest="keys", default=None,
+                      help="only analyze (or with --live, show) keys matching REGEX", metavar="REGEX")
+    parser.add_option("--per-window", dest="per_window", default=False, action="store_true",
+                      help="also print the rate statistics of every window")
+    parser.add_option("--alert", dest="alerts", default=[], action="append",
+                      help="warn when RULE holds, see above (repeatable)", metavar="RULE")
+    parser.add_option("--alert-command", dest="alert_command", default=None,
+                      help="shell command to run when an alert fires or resolves", metavar="CMD")
+    parser.add_option("--baseline-window", dest="baseline_window", default=600, type=float,
+                      help="seconds of history in an alert baseline [default: %default]", metavar="SECS")
+    parser.add_option("--prometheus", dest="prometheus", default=None,
+                      help="serve the latest values to Prometheus on [ADDR:]PORT", metavar="ADDR")
+    parser.add_option("--statsd", dest="statsd", default=None,
+                      help="send every sample to statsd at HOST[:PORT]", metavar="ADDR")
+    parser.add_option("-l", "--live", dest="live", default=False, action="store_true",
+                      help="show the fastest changing keys full screen instead of printing changes")
+    parser.add_option("--history", dest="history", default=60, type=int,
+                      help="rates per sparkline in --live [default: %default]", metavar="N")
+    parser.add_option("-q", "--quiet", dest="quiet", default=False, action="store_true",
+                      help="don't print changes, just record")
+    (opts, args) = parser.parse_args()
+    if opts.sleeptime < 0.001:
+        parser.error("invalid --sleeptime: %g" % opts.sleeptime)
+    samplers = []
+    for name in opts.commands.split(','):
+        if name not in SAMPLERS:
+            parser.error("unknown command in --commands: %s" % name)
+        samplers.append(SAMPLERS[name])
+    rules = []
+    for text in opts.alerts:
+        try:
+            rules.append(Rule(text))
+        except ValueError, e:
+            parser.error(str(e))
+    if opts.history < 1:
+        parser.error("invalid --history: %d" % opts.history)
+    if opts.baseline_window <= 0:
+        parser.error("invalid --baseline-window: %g" % opts.baseline_window)
+    prometheus = statsd = None
+    try:
+        if opts.prometheus is not None:
+            prometheus = parse_address(opts.prometheus, '')
+        if opts.statsd is not None:
+            if ':' not in opts.statsd:
+                opts.statsd += ':8125'
+            statsd = parse_address(opts.statsd, 'localhost')
+    except ValueError:
+        parser.error("invalid port in --prometheus or --statsd")
+
+    logging.basicConfig(level=logging.INFO)
+
+    if opts.analyze is not None:
+        pattern = None
+        if opts.keys is not None:
+            pattern = re.compile(opts.keys)
+        if opts.compare is not None:
+            return compare(opts.analyze, opts.compare, opts.window, pattern, opts.alpha)
+        return analyze(opts.analyze, opts.window, pattern, opts.per_window)
+    if opts.compare is not None:
+        parser.error("--compare needs --analyze")
+
+    hosts = args
+    if not hosts:
+        hosts = ["localhost:27017"]
+
+    if opts.discover:
+        found = set()
+        for host in hosts:
             try:
-                printit(stats, es, int(opts.sleeptime))
+                found |= discover(host)
             except:
-                logging.exception('error printing info')
-                return 3
+                logging.exception('error discovering members of %s', host)
+                return 1
+        hosts = sorted(found)
+        logging.info('polling %s', ', '.join(hosts))
+
+    results = Queue.Queue()
+    pollers = [Poller(host, samplers, results) for host in hosts]
+    for p in pollers:
+        p.start()
+
+    recorders = {}
+    if opts.record is not None:
+        for host in hosts:
+            recorders[host] = Recorder(os.path.join(opts.record, host), opts.block_samples)
 
-            time.sleep(int(opts.sleeptime))
+    alerter = None
+    if rules:
+        alerter = Alerter(rules, opts.alert_command, opts.baseline_window)
+
+    exporter = None
+    if prometheus is not None or statsd is not None:
+        exporter = Exporter(statsd)
+        if prometheus is not None:
+            start_prometheus(exporter, *prometheus)
+
+    tagged = len(hosts) > 1
+    stats = dict((host, HostStats()) for host in hosts)
+    dashboard = None
+    if opts.live and not opts.quiet:
+        pattern = None
+        if opts.keys is not None:
+            pattern = re.compile(opts.keys)
+        dashboard = Dashboard(opts.history, pattern, tagged)
+    interval = opts.sleeptime
+    # ticks are scheduled on the monotonic clock so they don't drift by however long each
+    # round takes, starting from the next multiple of the interval in wall clock time
+    now = time.time()
+    next_tick = monotonic() + math.ceil(now / interval) * interval - now
+    tick = 0
+    try:
+        while 1:
+            # sample every host on the same instant
+            delay = next_tick - monotonic()
+            if delay > 0:
+                if dashboard is not None:
+                    dashboard.wait(delay)
+                else:
+                    time.sleep(delay)
+            elif -delay > interval:
+                missed = int(-delay / interval)
+                logging.warning('sampling fell %d intervals behind', missed)
+                next_tick += missed * interval
+            tick += 1
+            tick_time = time.time()
+            for p in pollers:
+                p.tick(tick)
+            next_tick += interval
+
+            samples = {}
+            while len(samples) < len(pollers):
+                try:
+                    host, t, es, sample_time, clock, rtt = results.get(timeout=max(0, next_tick - monotonic()))
+                except Queue.Empty:
+                    break
+                if t == tick:
+                    samples[host] = (es, sample_time, clock, rtt)
+
+            if not opts.quiet and dashboard is None:
+                if interval < 1:
+                    logging.info('%s.%03d', time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(tick_time)),
+                                 int(tick_time * 1000) % 1000)
+                else:
+                    logging.info(time.strftime('%c', time.localtime(tick_time)))
+            for host in hosts:
+                es, sample_time, clock, rtt = samples.get(host, (None, None, None, None))
+                if es is None:
+                    if tagged:
+                        logging.warning('no sample from %s', host)
+                    continue
+                hs = stats[host]
+                hs.update(es, sample_time, clock, rtt)
+                if host in recorders:
+                    recorders[host].append(sample_time, rtt, hs.schema, hs.values)
+                if alerter is not None:
+                    alerter.check(host, hs)
+                if exporter is not None:
+                    exporter.update(host, hs)
+                if opts.quiet:
+                    continue
+                if dashboard is not None:
+                    dashboard.update(host, hs)
+                    continue
+                try:
+                    printit(hs, tagged and host or None)
+                except:
+                    logging.exception('error printing info')
+                    return 3
+            if dashboard is not None:
+                dashboard.draw(tick_time)
 
     except KeyboardInterrupt:
         logging.info('disconnecting')
+    finally:
+        if dashboard is not None:
+            dashboard.close()
+        for r in recorders.itervalues():
+            r.flush()
 
     return 0
 